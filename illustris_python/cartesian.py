@@ -3,9 +3,9 @@ cartesian.py: File I/O related to the cartesian output files (THESAN only). """
 from __future__ import print_function
 
 import numpy as np
-import h5py
 import six
-from os.path import isfile
+
+from .util import openFile, simulation
 
 
 def cartPath(basePath, cartNum, chunkNum=0):
@@ -13,9 +13,10 @@ def cartPath(basePath, cartNum, chunkNum=0):
     filePath_list = [ f'{basePath}/cartesian_{cartNum:03d}/cartesian_{cartNum:03d}.{chunkNum}.hdf5',
                     ]
 
-    for filePath in filePath_list:
-        if isfile(filePath):
-            return filePath
+    # the path scheme is detected once per cartesian output, see util.Simulation
+    filePath = simulation(basePath).resolve(('cartesian', cartNum), filePath_list)
+    if filePath is not None:
+        return filePath
 
     raise ValueError("No cartesian file found!")
 
@@ -36,7 +37,7 @@ def loadSubset(basePath, cartNum, fields=None, bbox=None, sq=True):
         fields = [fields]
 
     # load header from first chunk
-    with h5py.File(cartPath(basePath, cartNum), 'r') as f:
+    with openFile(cartPath(basePath, cartNum)) as f:
         header = dict(f['Header'].attrs.items())
         nPix = getNumPixel(header)
 
@@ -63,7 +64,7 @@ def loadSubset(basePath, cartNum, fields=None, bbox=None, sq=True):
     if numToRead==0:
         return result
 
-    with h5py.File(cartPath(basePath, cartNum, 0), 'r') as f:
+    with openFile(cartPath(basePath, cartNum, 0)) as f:
         # if fields not specified, load everything; otherwise check entry
         if not fields:
             fields = list(f.keys())
@@ -91,7 +92,7 @@ def loadSubset(basePath, cartNum, fields=None, bbox=None, sq=True):
 
 
     while numToRead:
-        with h5py.File(cartPath(basePath, cartNum, fileNum), 'r') as f:
+        with openFile(cartPath(basePath, cartNum, fileNum)) as f:
 
             # set local read length for this file chunk, truncate to be within the local size
             numPixelsLocal = f[fields[0]][()].shape[0]
@@ -3,13 +3,14 @@ groupcat.py: File I/O related to the FoF and Subfind group catalogs. """
 from __future__ import print_function
 
 import six
-from os import environ
-from os.path import isfile,expanduser,join
+from os import stat
+from os.path import join
 import numpy as np
-import h5py
 from pathlib import Path
 
-import multiprocessing as mp
+from .util import openFile, simulation, parallelMap, numProcs, sharedZeros, sharedSpec, openShared, readRows, \
+                  whereFields, whereMask, mapDataset, cachedArrays
+
 from functools import partial
 
 
@@ -19,9 +20,8 @@ def gcPath(basePath, snapNum, chunkNum=0):
     filePath1 = gcPath + 'groups_%03d.%d.hdf5' % (snapNum, chunkNum)
     filePath2 = gcPath + 'fof_subhalo_tab_%03d.%d.hdf5' % (snapNum, chunkNum)
 
-    if isfile(expanduser(filePath1)):
-        return filePath1
-    return filePath2
+    # the naming scheme is detected once per snapshot, see util.Simulation
+    return simulation(basePath).resolve(('groups', snapNum), [filePath1, filePath2]) or filePath2
 
 
 def offsetPath(basePath, snapNum):
@@ -31,65 +31,312 @@ def offsetPath(basePath, snapNum):
     return offsetPath
 
 
-def _readfunc(basePath, snapNum, gName, nName, fields, i):
-    """ Multiprocessing target for loadObjects() below. """
-    result = {}
+class Offsets(object):
+    """ Offset tables of one snapshot: the first halo/subhalo of each group catalog file chunk, and for
+        every halo/subhalo its particle offsets in the snapshot (SnapByType) and its merger tree offsets
+        (e.g. 'SubLink/RowNum' or 'LHaloTree/File'). Each table is loaded once, on first use (memory-mapped
+        when stored contiguously in the offsets file), from the separate offsets file (new format) or
+        the group catalog chunks (old format), after which lookups for arrays of IDs are plain array
+        indexing. Use loadOffsets() for the instance shared by all loaders. The tables are shared, hence
+        read-only: copy before modifying. """
+
+    def __init__(self, basePath, snapNum):
+        self.basePath = basePath
+        self.snapNum = snapNum
+        self.newFormat = 'fof_subhalo' in gcPath(basePath, snapNum) # old or new format
+        self.tables = {}
+
+    def _load(self, key, func):
+        if key not in self.tables:
+            table = func()
+            for array in (table.values() if isinstance(table, dict) else [table]):
+                array.setflags(write=False)
+            self.tables[key] = table
+        return self.tables[key]
+
+    def fileOffsets(self, gName):
+        """ Index of the first halo (gName='Group') or subhalo (gName='Subhalo') of each file chunk. """
+        def _read():
+            if self.newFormat:
+                # use separate 'offsets_nnn.hdf5' files
+                with openFile(offsetPath(self.basePath, self.snapNum)) as f:
+                    return f['FileOffsets/'+gName][()]
+            # use header of group catalog
+            return np.array(loadHeader(self.basePath, self.snapNum)['FileOffsets_'+gName])
+
+        return self._load(('FileOffsets', gName), _read)
+
+    def snapOffsets(self):
+        """ Index of the first particle of each type in each snapshot file chunk, shape [nTypes, nChunks]. """
+        def _read():
+            if self.newFormat:
+                with openFile(offsetPath(self.basePath, self.snapNum)) as f:
+                    return np.transpose(f['FileOffsets/SnapByType'][()]) # consistency
+            return np.array(loadHeader(self.basePath, self.snapNum)['FileOffsets_Snap'])
+
+        return self._load(('FileOffsets', 'Snap'), _read)
+
+    def locate(self, gName, ids):
+        """ Return the file chunk containing each of the given halo/subhalo IDs, and the index of each
+            within its chunk. """
+        fileOffsets = self.fileOffsets(gName)
+        ids = np.asarray(ids, dtype=np.int64)
+        fileNums = np.searchsorted(fileOffsets, ids, side='right') - 1
+        return fileNums, ids - fileOffsets[fileNums]
+
+    def table(self, gName, name):
+        """ Return the offset table name (named as in the offsets files, e.g. 'SnapByType' or
+            'SubLink/RowNum') of all halos/subhalos, indexable by ID. """
+        def _read():
+            # old format: tables are split over the group catalog chunks (as 'Offsets/Subhalo_SublinkRowNum')
+            oldName = None
+            if name == 'SnapByType':
+                oldName = gName + '_SnapByType'
+            elif name.startswith('SubLink/'):
+                oldName = gName + '_Sublink' + name[len('SubLink/'):]
+            elif name.startswith('LHaloTree/'):
+                oldName = gName + '_LHaloTree' + name[len('LHaloTree/'):]
+
+            if not self.newFormat and oldName is not None:
+                return self._readChunks(gName, 'Offsets/' + oldName)
+
+            return mapDataset(offsetPath(self.basePath, self.snapNum), gName + '/' + name)
+
+        return self._load((gName, name), _read)
+
+    def lenType(self, gName, ids):
+        """ Return the number of particles of each type of the given halos/subhalos, shape [len(ids), nTypes].
+            Read from the group catalog, each chunk with a few coalesced reads (see util.readRows). """
+        uniqueIDs, inverse = np.unique(np.asarray(ids, dtype=np.int64), return_inverse=True)
+        fileNums, groupOffsets = self.locate(gName, uniqueIDs)
+        lenType = None
+
+        for fileNum in np.unique(fileNums):
+            w = np.where(fileNums == fileNum)[0]
+            with openFile(gcPath(self.basePath, self.snapNum, fileNum)) as f:
+                data = readRows(f[gName][gName+'LenType'], groupOffsets[w])
+            if lenType is None:
+                lenType = np.zeros((uniqueIDs.size,) + data.shape[1:], dtype=data.dtype)
+            lenType[w] = data
+
+        if lenType is None:
+            return np.zeros((0, 6), dtype=np.int64)
+
+        return lenType[inverse]
+
+    def originalZooms(self):
+        """ Return the TNG-Cluster specific offsets (OriginalZooms), if present. """
+        def _read():
+            if not self.newFormat:
+                return {}
+            with openFile(offsetPath(self.basePath, self.snapNum)) as f:
+                if 'OriginalZooms' not in f:
+                    return {}
+                return {key: f['OriginalZooms'][key][()] for key in f['OriginalZooms']}
+
+        return self._load('OriginalZooms', _read)
+
+    def _readChunks(self, gName, name):
+        """ Concatenate a per-object dataset over all group catalog file chunks. """
+        header = loadHeader(self.basePath, self.snapNum)
+        nName = 'groups' if gName == 'Group' else 'subgroups'
+        if 'N'+nName+'_Total' not in header and nName == 'subgroups':
+            nName = 'subhalos' # alternate convention
 
-    f = h5py.File(gcPath(basePath, snapNum, i), 'r')
+        numLocal = _chunkCounts(self.basePath, self.snapNum, nName, header['NumFiles'])
+        data = []
 
-    if not f['Header'].attrs['N'+nName+'_ThisFile']:
-        f.close()
-        return None # empty file chunk
+        for i in np.where(numLocal > 0)[0]: # skip empty file chunks
+            with openFile(gcPath(self.basePath, self.snapNum, i)) as f:
+                data.append(f[name][()])
 
-    # loop over each requested field and read data local to this chunk
-    for field in fields:
-        result[field] = f[gName][field][()]
+        return np.concatenate(data)
+
+
+def loadOffsets(basePath, snapNum):
+    """ Return the Offsets of a snapshot shared by all loaders (see util.Simulation). """
+    return simulation(basePath).memo(('offsets', snapNum), lambda: Offsets(basePath, snapNum))
+
+
+class Hierarchy(object):
+    """ Halo-subhalo hierarchy of one snapshot, in compressed sparse row form: the subhalos of halo i are
+        the consecutive subhalos GroupFirstSub[i], ..., GroupFirstSub[i]+GroupNsubs[i]-1, the first of
+        which is its central, and SubhaloGrNr maps each subhalo back to its halo. GroupFirstSub is -1
+        for halos without subhalos. Use loadHierarchy() to build (once), cache and load it. """
+
+    def __init__(self, GroupFirstSub, GroupNsubs, SubhaloGrNr):
+        self.GroupFirstSub = GroupFirstSub
+        self.GroupNsubs = GroupNsubs
+        self.SubhaloGrNr = SubhaloGrNr
+
+    def subhalosOf(self, groupIDs):
+        """ Return the subhalos of the given halos, as a dict with the concatenated subhalo IDs of all
+            halos ('subhalos'), in the order of groupIDs, together with offsets and lengths giving the
+            range of each halo. """
+        groupIDs = np.asarray(groupIDs, dtype=np.int64).ravel()
+        lengths = np.asarray(self.GroupNsubs[groupIDs], dtype=np.int64)
+        offsets = np.cumsum(lengths) - lengths
+        starts = np.asarray(self.GroupFirstSub[groupIDs], dtype=np.int64)
+
+        subhalos = np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+
+        return {'count': subhalos.size, 'subhalos': subhalos, 'offsets': offsets, 'lengths': lengths}
+
+    def parentOf(self, subhaloIDs):
+        """ Return the halo of each of the given subhalos. """
+        return np.asarray(self.SubhaloGrNr[np.asarray(subhaloIDs, dtype=np.int64)])
+
+    def centralOf(self, groupIDs=None, subhaloIDs=None):
+        """ Return the central subhalo of each of the given halos, or of the halo of each of the given
+            subhalos (-1 for halos without subhalos). """
+        if (groupIDs is None) == (subhaloIDs is None):
+            raise Exception("Must specify either groupIDs or subhaloIDs (and not both).")
+        if groupIDs is None:
+            groupIDs = self.parentOf(subhaloIDs)
+        return np.asarray(self.GroupFirstSub[np.asarray(groupIDs, dtype=np.int64)])
+
+    def isCentral(self, subhaloIDs=None):
+        """ Return a mask which is True for centrals, for the given (or all) subhalos. """
+        if subhaloIDs is None:
+            subhaloIDs = np.arange(self.SubhaloGrNr.size)
+        subhaloIDs = np.asarray(subhaloIDs, dtype=np.int64)
+        return self.centralOf(subhaloIDs=subhaloIDs) == subhaloIDs
+
+    def isSatellite(self, subhaloIDs=None):
+        """ Return a mask which is True for satellites, for the given (or all) subhalos. """
+        return ~self.isCentral(subhaloIDs)
+
+
+def _buildHierarchy(basePath, snapNum):
+    """ Collect the hierarchy arrays of a snapshot from the group catalog. """
+    halos = loadHalos(basePath, snapNum, fields=['GroupFirstSub', 'GroupNsubs'])
+    subhaloGrNr = loadSubhalos(basePath, snapNum, fields=['SubhaloGrNr'])
+
+    if not halos['count']: # empty catalog
+        halos = {'GroupFirstSub': np.zeros(0, dtype=np.int64), 'GroupNsubs': np.zeros(0, dtype=np.int64)}
+    if isinstance(subhaloGrNr, dict): # no subhalos, count only
+        subhaloGrNr = np.zeros(0, dtype=np.int64)
+
+    # the smallest signed type holding all IDs (with -1 for none)
+    numMax = max(halos['GroupFirstSub'].size, subhaloGrNr.size)
+    dtype = np.int32 if numMax < np.iinfo(np.int32).max else np.int64
+
+    groupNsubs = halos['GroupNsubs'].astype(dtype)
+    groupFirstSub = np.where(groupNsubs > 0, halos['GroupFirstSub'], -1).astype(dtype)
+
+    return {'GroupFirstSub': groupFirstSub, 'GroupNsubs': groupNsubs, 'SubhaloGrNr': subhaloGrNr.astype(dtype)}
+
+
+def loadHierarchy(basePath, snapNum, cache=True):
+    """ Return the Hierarchy of a snapshot. It is built once from GroupFirstSub, GroupNsubs and
+        SubhaloGrNr, then kept in memory and in a sidecar file (see util.cachePath) whose arrays are
+        memory-mapped. If cache is False, always rebuild it. """
+    key = ('hierarchy', snapNum)
+    sim = simulation(basePath)
+
+    if cache and key in sim.values:
+        return sim.values[key]
+
+    def stamp():
+        st = stat(gcPath(basePath, snapNum))
+        return np.array([st.st_size, st.st_mtime_ns], dtype=np.int64)
+
+    arrays = cachedArrays(basePath, 'hierarchy_%03d.hdf5' % snapNum, stamp,
+                          lambda f: _buildHierarchy(basePath, snapNum), cache)
+
+    sim.values[key] = Hierarchy(**arrays)
+
+    return sim.values[key]
+
+
+def _chunkCounts(basePath, snapNum, nName, numFiles):
+    """ Number of objects in each file chunk (read once per snapshot, see util.Simulation). """
+    def _read():
+        counts = np.zeros(numFiles, dtype=np.int64)
+        for i in range(numFiles):
+            with openFile(gcPath(basePath, snapNum, i)) as f:
+                counts[i] = f['Header'].attrs['N'+nName+'_ThisFile']
+        return counts
+
+    return simulation(basePath).memo(('groupsChunkCounts', snapNum, nName), _read)
+
+
+def _readChunk(basePath, snapNum, gName, fields, result, i, wOffset, numLocal):
+    """ Read all fields of one file chunk directly into its slice of the result arrays. """
+    with openFile(gcPath(basePath, snapNum, i)) as f:
+        # loop over each requested field
+        for field in fields:
+            if field not in f[gName].keys():
+                raise Exception("Group catalog does not have requested field [" + field + "]!")
+
+            # read data local to the current file
+            f[gName][field].read_direct(result[field], dest_sel=np.s_[wOffset:wOffset+numLocal])
+
+
+def _readShared(basePath, snapNum, gName, specs, i, wOffset, numLocal):
+    """ Worker process target for loadObjects(): read all fields of one file chunk directly into their
+        shared result arrays, given by their sharedSpec (see util.sharedZeros) by field. """
+    result = {field: openShared(spec) for field, spec in specs.items()}
+    _readChunk(basePath, snapNum, gName, list(specs.keys()), result, i, wOffset, numLocal)
+
+
+def _readColumns(basePath, snapNum, gName, fields, i, rows=None):
+    """ Worker process target for query(): read fields of one file chunk, all rows or only the given
+        (sorted, unique) ones, and return them. """
+    with openFile(gcPath(basePath, snapNum, i)) as f:
+        result = {}
+        for field in fields:
+            if field not in f[gName].keys():
+                raise Exception("Group catalog does not have requested field [" + field + "]!")
+
+            result[field] = f[gName][field][()] if rows is None else readRows(f[gName][field], rows)
 
-    f.close()
     return result
 
+
 def loadObjects(basePath, snapNum, gName, nName, fields, nThreads=None):
-    """ Load either halo or subhalo information from the group catalog. """
+    """ Load either halo or subhalo information from the group catalog. Each file chunk is read directly
+        into its slice of the result arrays. If nThreads > 1 (by default, OMP_NUM_THREADS, then with
+        worker processes for this call only), read that many file chunks concurrently in worker
+        processes (see util.parallelMap), into result arrays allocated in shared memory (see
+        util.sharedZeros). """
     result = {}
-
-    if nThreads is None:
-        nThreads = int(environ.get('OMP_NUM_THREADS', 1))
+    parallel = numProcs(nThreads) > 1
 
     # make sure fields is not a single element
     if isinstance(fields, six.string_types):
         fields = [fields]
 
     # load header from first chunk
-    with h5py.File(gcPath(basePath, snapNum), 'r') as f:
-
-        header = dict(f['Header'].attrs.items())
+    header = loadHeader(basePath, snapNum)
 
-        if 'N'+nName+'_Total' not in header and nName == 'subgroups':
-            nName = 'subhalos' # alternate convention
+    if 'N'+nName+'_Total' not in header and nName == 'subgroups':
+        nName = 'subhalos' # alternate convention
 
-        result['count'] = np.int64(f['Header'].attrs['N' + nName + '_Total'])
+    result['count'] = np.int64(header['N' + nName + '_Total'])
 
-        if not result['count']:
-            print('warning: zero groups, empty return (snap=' + str(snapNum) + ').')
-            return result
+    if not result['count']:
+        print('warning: zero groups, empty return (snap=' + str(snapNum) + ').')
+        return result
 
     # special case: single file? about x2 faster because of overhead of ndarray[:] = data, rather than ndarray = data.
     if header['NumFiles'] == 1:
-        with h5py.File(gcPath(basePath, snapNum), 'r') as f:
+        with openFile(gcPath(basePath, snapNum)) as f:
             for field in fields:
                 result[field] = f[gName][field][()]
         if len(fields) == 1:
             return result[fields[0]]
         return result
 
-    with h5py.File(gcPath(basePath, snapNum), 'r') as f:
-        # find a chunk with objects of this type
-        i = 1
-        while len(f[gName].keys()) == 0:
-            f.close()
-            f = h5py.File(gcPath(basePath, snapNum, i), 'r')
-            i += 1
+    # find a chunk with objects of this type
+    i = 0
+    while True:
+        with openFile(gcPath(basePath, snapNum, i)) as f:
+            if len(f[gName].keys()) > 0:
+                break
+        i += 1
 
+    with openFile(gcPath(basePath, snapNum, i)) as f:
         # if fields not specified, load everything
         if not fields:
             fields = list(f[gName].keys())
@@ -104,85 +351,116 @@ def loadObjects(basePath, snapNum, gName, nName, fields, nThreads=None):
             shape[0] = result['count']
 
             # allocate within return dict
-            result[field] = np.zeros(shape, dtype=f[gName][field].dtype)
+            result[field] = (sharedZeros if parallel else np.zeros)(shape, dtype=f[gName][field].dtype)
+
+    # the write offset of each chunk is known in advance, so chunks can be read in any order, or concurrently
+    numLocal = _chunkCounts(basePath, snapNum, nName, header['NumFiles'])
+    wOffsets = np.cumsum(numLocal) - numLocal
+    fileNums = np.where(numLocal > 0)[0] # skip empty file chunks
 
-    # loop over chunks
-    if mp.current_process().name != "MainProcess":
-        nThreads = 1 # already inside daemonic child process, cannot spawn more children
-        
-    if nThreads == 1 or header['NumFiles'] == 1:
-        # serial load
-        wOffset = 0
+    specs = {field: sharedSpec(result[field]) for field in fields}
 
-        for i in range(header['NumFiles']):
-            f = h5py.File(gcPath(basePath, snapNum, i), 'r')
+    if parallel and fileNums.size > 1 and None not in specs.values():
+        # h5py serializes reads within one process, so chunks are read by worker processes
+        func = partial(_readShared, basePath, snapNum, gName, specs)
+        list(parallelMap(func, nThreads, fileNums, wOffsets[fileNums], numLocal[fileNums]))
+    else:
+        func = partial(_readChunk, basePath, snapNum, gName, fields, result)
+        list(map(func, fileNums, wOffsets[fileNums], numLocal[fileNums]))
 
-            if not f['Header'].attrs['N'+nName+'_ThisFile']:
-                f.close()
-                continue  # empty file chunk
+    # only a single field? then return the array instead of a single item dict
+    if len(fields) == 1:
+        return result[fields[0]]
 
-            # loop over each requested field
-            for field in fields:
-                if field not in f[gName].keys():
-                    raise Exception("Group catalog does not have requested field [" + field + "]!")
+    return result
 
-                # shape and type
-                shape = f[gName][field].shape
 
-                # read data local to the current file
-                result[field][wOffset:wOffset+shape[0], ...] = f[gName][field][()]
+def query(basePath, snapNum, gName, where, fields=None, nThreads=1):
+    """ Select halos (gName='Group') or subhalos (gName='Subhalo') satisfying the condition(s) where,
+        for example where=[('SubhaloFlag', '==', 1), ('SubhaloMassType', lambda m: m[:, 4] > 1.0)]
+        (see util.whereMask), and load fields (all, if None) for the matching ones only. The condition
+        is evaluated chunk by chunk on the columns it needs, and the requested columns are then read
+        just for the matching rows. Return a dict with the global index ('index', i.e. the halo or
+        subhalo ID) of each match, its 'count', and one array per field. If nThreads > 1, read that
+        many file chunks concurrently in worker processes (see util.parallelMap), while the condition
+        is evaluated here, such that it may use any function. """
+    nName = 'subgroups' if gName == 'Subhalo' else 'groups'
 
-            wOffset += shape[0]
-            f.close()
-    else:
-        # parallelized load
-        pool = mp.Pool(processes=nThreads)
+    # make sure fields is not a single element
+    if isinstance(fields, six.string_types):
+        fields = [fields]
 
-        fileNums = range(header['NumFiles'])
-        func = partial(_readfunc,basePath,snapNum,gName,nName,fields)
-        p_results = pool.map(func, fileNums)
-        pool.close()
+    header = loadHeader(basePath, snapNum)
+    if 'N'+nName+'_Total' not in header and nName == 'subgroups':
+        nName = 'subhalos' # alternate convention
 
-        # write
-        wOffset = 0
+    numLocal = _chunkCounts(basePath, snapNum, nName, header['NumFiles'])
+    wOffsets = np.cumsum(numLocal) - numLocal
+    fileNums = np.where(numLocal > 0)[0] # skip empty file chunks
 
-        for i in range(header['NumFiles']):
-            if p_results[i] is None:
-                continue # no objects in this chunk
+    if not fileNums.size:
+        print('warning: zero groups, empty return (snap=' + str(snapNum) + ').')
+        result = {'index': np.zeros(0, dtype=np.int64), 'count': 0}
 
-            for field in fields:
-                numLoc = p_results[i][field].shape[0]
-                result[field][wOffset:wOffset+numLoc,...] = p_results[i][field]
+        # empty arrays of the requested fields, typed as stored (if at all) by the first file chunk
+        with openFile(gcPath(basePath, snapNum)) as f:
+            for field in (fields or []):
+                if gName in f and field in f[gName]:
+                    result[field] = np.zeros((0,) + f[gName][field].shape[1:], dtype=f[gName][field].dtype)
+        return result
 
-            wOffset += numLoc
+    if not fields:
+        with openFile(gcPath(basePath, snapNum, fileNums[0])) as f:
+            fields = list(f[gName].keys())
+    chunks = []
 
-    # only a single field? then return the array instead of a single item dict
-    if len(fields) == 1:
-        return result[fields[0]]
+    # evaluate the condition chunk by chunk, on the columns it needs only
+    func = partial(_readColumns, basePath, snapNum, gName, whereFields(where))
+
+    for i, data in zip(fileNums, parallelMap(func, nThreads, fileNums)):
+        rows = np.where(whereMask(where, data))[0]
+        chunks.append({field: data[field][rows] for field in fields if field in data})
+        chunks[-1]['index'] = rows + wOffsets[i]
+
+    # then read the other fields for the matching rows only
+    otherFields = [field for field in fields if field not in whereFields(where)]
+    rows = [chunk['index'] - wOffsets[i] for i, chunk in zip(fileNums, chunks)]
+    func = partial(_readColumns, basePath, snapNum, gName, otherFields)
+
+    for chunk, data in zip(chunks, parallelMap(func, nThreads, fileNums, rows)):
+        chunk.update(data)
+
+    # concatenate the matches of all chunks, in order
+    result = {'index': np.concatenate([chunk['index'] for chunk in chunks] + [np.zeros(0, dtype=np.int64)])}
+    result['count'] = result['index'].size
+
+    for field in fields:
+        result[field] = np.concatenate([chunk[field] for chunk in chunks])
 
     return result
 
 
-def loadSubhalos(basePath, snapNum, fields=None):
+def loadSubhalos(basePath, snapNum, fields=None, nThreads=None):
     """ Load all subhalo information from the entire group catalog for one snapshot
        (optionally restrict to a subset given by fields). """
 
-    return loadObjects(basePath, snapNum, "Subhalo", "subgroups", fields)
+    return loadObjects(basePath, snapNum, "Subhalo", "subgroups", fields, nThreads)
 
 
-def loadHalos(basePath, snapNum, fields=None):
+def loadHalos(basePath, snapNum, fields=None, nThreads=None):
     """ Load all halo information from the entire group catalog for one snapshot
        (optionally restrict to a subset given by fields). """
 
-    return loadObjects(basePath, snapNum, "Group", "groups", fields)
+    return loadObjects(basePath, snapNum, "Group", "groups", fields, nThreads)
 
 
 def loadHeader(basePath, snapNum):
-    """ Load the group catalog header. """
-    with h5py.File(gcPath(basePath, snapNum), 'r') as f:
-        header = dict(f['Header'].attrs.items())
+    """ Load the group catalog header (read once per snapshot, see util.Simulation). """
+    def _read():
+        with openFile(gcPath(basePath, snapNum)) as f:
+            return dict(f['Header'].attrs.items())
 
-    return header
+    return dict(simulation(basePath).memo(('groupsHeader', snapNum), _read))
 
 
 def load(basePath, snapNum):
@@ -202,25 +480,78 @@ def loadSingle(basePath, snapNum, haloID=-1, subhaloID=-1):
     gName = "Subhalo" if subhaloID >= 0 else "Group"
     searchID = subhaloID if subhaloID >= 0 else haloID
 
-    # old or new format
-    if 'fof_subhalo' in gcPath(basePath, snapNum):
-        # use separate 'offsets_nnn.hdf5' files
-        with h5py.File(offsetPath(basePath, snapNum), 'r') as f:
-            offsets = f['FileOffsets/'+gName][()]
-    else:
-        # use header of group catalog
-        with h5py.File(gcPath(basePath, snapNum), 'r') as f:
-            offsets = f['Header'].attrs['FileOffsets_'+gName]
-
-    offsets = searchID - offsets
-    fileNum = np.max(np.where(offsets >= 0))
-    groupOffset = offsets[fileNum]
+    # calculate target groups file chunk which contains this id
+    fileNums, groupOffsets = loadOffsets(basePath, snapNum).locate(gName, [searchID])
+    fileNum, groupOffset = fileNums[0], groupOffsets[0]
 
     # load halo/subhalo fields into a dict
     result = {}
 
-    with h5py.File(gcPath(basePath, snapNum, fileNum), 'r') as f:
+    with openFile(gcPath(basePath, snapNum, fileNum)) as f:
         for haloProp in f[gName].keys():
             result[haloProp] = f[gName][haloProp][groupOffset]
 
     return result
+
+
+def loadSingles(basePath, snapNum, haloIDs=None, subhaloIDs=None, fields=None):
+    """ Return group catalog information for many halos or subhalos at once (vectorized loadSingle),
+        optionally restricted to a subset given by fields. IDs are mapped to file chunks with a single
+        search, and each field is read once per chunk with a few coalesced reads (see util.readRows).
+        Return a dict with one array per field, aligned with the given IDs. """
+    if (haloIDs is None) == (subhaloIDs is None):
+        raise Exception("Must specify either haloIDs or subhaloIDs (and not both).")
+
+    gName = "Subhalo" if subhaloIDs is not None else "Group"
+    searchIDs = np.asarray(subhaloIDs if subhaloIDs is not None else haloIDs, dtype=np.int64).ravel()
+
+    # make sure fields is not a single element
+    if isinstance(fields, six.string_types):
+        fields = [fields]
+
+    # each distinct ID is read once, in storage order
+    uniqueIDs, inverse = np.unique(searchIDs, return_inverse=True)
+    fileNums, groupOffsets = loadOffsets(basePath, snapNum).locate(gName, uniqueIDs)
+
+    result = {'count': searchIDs.size}
+
+    if not searchIDs.size:
+        # no IDs: empty arrays, typed as stored by the first file chunk
+        with openFile(gcPath(basePath, snapNum)) as f:
+            if not fields:
+                fields = list(f[gName].keys())
+
+            for field in fields:
+                if field not in f[gName].keys():
+                    raise Exception("Group catalog does not have requested field [" + field + "]!")
+                result[field] = np.zeros((0,) + f[gName][field].shape[1:], dtype=f[gName][field].dtype)
+
+    for fileNum in np.unique(fileNums):
+        w = np.where(fileNums == fileNum)[0]
+
+        with openFile(gcPath(basePath, snapNum, fileNum)) as f:
+            # if fields not specified, load everything
+            if not fields:
+                fields = list(f[gName].keys())
+
+            for field in fields:
+                # verify existence
+                if field not in f[gName].keys():
+                    raise Exception("Group catalog does not have requested field [" + field + "]!")
+
+                # allocate within return dict
+                if field not in result:
+                    dset = f[gName][field]
+                    result[field] = np.zeros((uniqueIDs.size,) + dset.shape[1:], dtype=dset.dtype)
+
+                result[field][w] = readRows(f[gName][field], groupOffsets[w])
+
+    # back into the order (and multiplicity) of the requested IDs
+    for field in fields or []:
+        result[field] = result[field][inverse]
+
+    # only a single field? then return the array instead of a single item dict
+    if fields is not None and len(fields) == 1:
+        return result[fields[0]]
+
+    return result
@@ -2,11 +2,10 @@
 lhalotree.py: File I/O related to the LHaloTree merger tree files. """
 
 import numpy as np
-import h5py
 import six
 
-from .groupcat import gcPath, offsetPath
-from os.path import isfile
+from .groupcat import loadOffsets
+from .util import openFile, simulation
 
 
 def treePath(basePath, chunkNum=0):
@@ -17,44 +16,24 @@ def treePath(basePath, chunkNum=0):
                       basePath + '/../postprocessing/trees/LHaloTree/trees_sf1_080.' + str(chunkNum) + '.hdf5', #Thesan
                     ]
 
-    for filePath in filePath_list:
-        if isfile(filePath):
-            return filePath
+    # the path scheme is detected once, see util.Simulation
+    filePath = simulation(basePath).resolve(('lhalotree',), filePath_list)
+    if filePath is not None:
+        return filePath
 
     raise ValueError("No tree file found!")
 
 
 def treeOffsets(basePath, snapNum, id):
     """ Handle offset loading for a LHaloTree merger tree cutout. """
-    # load groupcat chunk offsets from header of first file (old or new format)
-    if 'fof_subhalo' in gcPath(basePath, snapNum):
-        # load groupcat chunk offsets from separate 'offsets_nnn.hdf5' files
-        with h5py.File(offsetPath(basePath, snapNum), 'r') as f:
-            groupFileOffsets = f['FileOffsets/Subhalo'][()]
+    # tables from the offsets file (new format) or group catalog (old format), loaded once
+    offsets = loadOffsets(basePath, snapNum)
 
-        offsetFile = offsetPath(basePath, snapNum)
-        prefix = 'Subhalo/LHaloTree/'
-
-        groupOffset = id
-    else:
-        # load groupcat chunk offsets from header of first file
-        with h5py.File(gcPath(basePath, snapNum), 'r') as f:
-            groupFileOffsets = f['Header'].attrs['FileOffsets_Subhalo']
-
-        # calculate target groups file chunk which contains this id
-        groupFileOffsets = int(id) - groupFileOffsets
-        fileNum = np.max(np.where(groupFileOffsets >= 0))
-        groupOffset = groupFileOffsets[fileNum]
-
-        offsetFile = gcPath(basePath, snapNum, fileNum)
-        prefix = 'Offsets/Subhalo_LHaloTree'
-
-    with h5py.File(offsetFile, 'r') as f:
-        # load the merger tree offsets of this subgroup
-        TreeFile  = f[prefix+'File'][groupOffset]
-        TreeIndex = f[prefix+'Index'][groupOffset]
-        TreeNum   = f[prefix+'Num'][groupOffset]
-        return TreeFile, TreeIndex, TreeNum
+    # load the merger tree offsets of this subgroup
+    TreeFile  = offsets.table('Subhalo', 'LHaloTree/File')[id]
+    TreeIndex = offsets.table('Subhalo', 'LHaloTree/Index')[id]
+    TreeNum   = offsets.table('Subhalo', 'LHaloTree/Num')[id]
+    return TreeFile, TreeIndex, TreeNum
 
 
 def singleNodeFlat(conn, index, data_in, data_out, count, onlyMPB):
@@ -106,58 +85,55 @@ def loadTree(basePath, snapNum, id, fields=None, onlyMPB=False):
     if isinstance(fields, six.string_types):
         fields = [fields]
 
-    fTree = h5py.File(treePath(basePath, TreeFile), 'r')
-
-    # if no fields requested, return everything
-    if not fields:
-        fields = list(fTree[gName].keys())
-
-    # verify existence of requested fields
-    for field in fields:
-        if field not in fTree[gName].keys():
-            raise Exception('Error: Requested field '+field+' not in tree.')
-
-    # load connectivity for this entire TreeX group
-    connFields = ['FirstProgenitor', 'NextProgenitor']
-    conn = {}
-
-    for field in connFields:
-        conn[field] = fTree[gName][field][:]
-
-    # determine sub-tree size with dummy walk
-    dummy = np.zeros(conn['FirstProgenitor'].shape, dtype='int32')
-    nRows = singleNodeFlat(conn, TreeIndex, dummy, dummy, 0, onlyMPB)
-
-    result = {}
-    result['count'] = nRows
-
-    # walk through connectivity, one data field at a time
-    for field in fields:
-        # load field for entire tree? doing so is much faster than randomly accessing the disk
-        # during walk, assuming that the sub-tree is a large fraction of the full tree, and that
-        # the sub-tree is large in the absolute sense. the decision is heuristic, and can be
-        # modified (if you have the tree on a fast SSD, could disable the full load).
-        if nRows < 1000:  # and float(nRows)/len(result['FirstProgenitor']) > 0.1
-            # do not load, walk with single disk reads
-            full_data = fTree[gName][field]
-        else:
-            # pre-load all, walk in-memory
-            full_data = fTree[gName][field][:]
-
-        # allocate the data array in the sub-tree
-        dtype = fTree[gName][field].dtype
-        shape = list(fTree[gName][field].shape)
-        shape[0] = nRows
-
-        data = np.zeros(shape, dtype=dtype)
-
-        # walk the tree, depth-first
-        count = singleNodeFlat(conn, TreeIndex, full_data, data, 0, onlyMPB)
-
-        # save field
-        result[field] = data
-
-    fTree.close()
+    with openFile(treePath(basePath, TreeFile)) as fTree:
+        # if no fields requested, return everything
+        if not fields:
+            fields = list(fTree[gName].keys())
+
+        # verify existence of requested fields
+        for field in fields:
+            if field not in fTree[gName].keys():
+                raise Exception('Error: Requested field '+field+' not in tree.')
+
+        # load connectivity for this entire TreeX group
+        connFields = ['FirstProgenitor', 'NextProgenitor']
+        conn = {}
+
+        for field in connFields:
+            conn[field] = fTree[gName][field][:]
+
+        # determine sub-tree size with dummy walk
+        dummy = np.zeros(conn['FirstProgenitor'].shape, dtype='int32')
+        nRows = singleNodeFlat(conn, TreeIndex, dummy, dummy, 0, onlyMPB)
+
+        result = {}
+        result['count'] = nRows
+
+        # walk through connectivity, one data field at a time
+        for field in fields:
+            # load field for entire tree? doing so is much faster than randomly accessing the disk
+            # during walk, assuming that the sub-tree is a large fraction of the full tree, and that
+            # the sub-tree is large in the absolute sense. the decision is heuristic, and can be
+            # modified (if you have the tree on a fast SSD, could disable the full load).
+            if nRows < 1000:  # and float(nRows)/len(result['FirstProgenitor']) > 0.1
+                # do not load, walk with single disk reads
+                full_data = fTree[gName][field]
+            else:
+                # pre-load all, walk in-memory
+                full_data = fTree[gName][field][:]
+
+            # allocate the data array in the sub-tree
+            dtype = fTree[gName][field].dtype
+            shape = list(fTree[gName][field].shape)
+            shape[0] = nRows
+
+            data = np.zeros(shape, dtype=dtype)
+
+            # walk the tree, depth-first
+            count = singleNodeFlat(conn, TreeIndex, full_data, data, 0, onlyMPB)
+
+            # save field
+            result[field] = data
 
     # only a single field? then return the array instead of a single item dict
     if len(fields) == 1:
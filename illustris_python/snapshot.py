@@ -1,268 +1,1538 @@
-""" Illustris Simulation: Public Data Release.
-snapshot.py: File I/O related to the snapshot files. """
-from __future__ import print_function
-
-import numpy as np
-import h5py
-import six
-from os.path import isfile
-
-from .util import partTypeNum
-from .groupcat import gcPath, offsetPath, loadSingle
-
-def snapPath(basePath, snapNum, chunkNum=0):
-    """ Return absolute path to a snapshot HDF5 file (modify as needed). """
-    snapPath = basePath + '/snapdir_' + str(snapNum).zfill(3) + '/'
-    filePath1 = snapPath + 'snap_' + str(snapNum).zfill(3) + '.' + str(chunkNum) + '.hdf5'
-    filePath2 = filePath1.replace('/snap_', '/snapshot_')
-
-    if isfile(filePath1):
-        return filePath1
-    return filePath2
-
-def getNumPart(header):
-    """ Calculate number of particles of all types given a snapshot header. """
-    if 'NumPart_Total_HighWord' not in header:
-        return np.int64(header['NumPart_Total']) # new uint64 convention
-
-    nTypes = 6
-
-    nPart = np.zeros(nTypes, dtype=np.int64)
-    for j in range(nTypes):
-        nPart[j] = header['NumPart_Total'][j] | (np.int64(header['NumPart_Total_HighWord'][j]) << 32)
-
-    return nPart
-
-
-def loadSubset(basePath, snapNum, partType, fields=None, subset=None, mdi=None, sq=True, float32=False, result=None):
-    """ Load a subset of fields for all particles/cells of a given partType.
-        If offset and length specified, load only that subset of the partType.
-        If mdi is specified, must be a list of integers of the same length as fields,
-        giving for each field the multi-dimensional index (on the second dimension) to load.
-          For example, fields=['Coordinates', 'Masses'] and mdi=[1, None] returns a 1D array
-          of y-Coordinates only, together with Masses.
-        If sq is True, return a numpy array instead of a dict if len(fields)==1.
-        If float32 is True, load any float64 datatype arrays directly as float32 (save memory). 
-        If result is not None, should be a dict containing pre-allocated ndarrays for each 
-        requested field. And optionally: {field}_write_offset specifying the starting write offset 
-        to place the result within result[{field}]."""
-    if result is None: result = {}
-
-    ptNum = partTypeNum(partType)
-    gName = "PartType" + str(ptNum)
-
-    # make sure fields is not a single element
-    if isinstance(fields, six.string_types):
-        fields = [fields]
-
-    # load header from first chunk
-    with h5py.File(snapPath(basePath, snapNum), 'r') as f:
-
-        header = dict(f['Header'].attrs.items())
-        nPart = getNumPart(header)
-
-        # decide global read size, starting file chunk, and starting file chunk offset
-        if subset:
-            offsetsThisType = subset['offsetType'][ptNum] - subset['snapOffsets'][ptNum, :]
-
-            fileNum = np.max(np.where(offsetsThisType >= 0))
-            fileOff = offsetsThisType[fileNum]
-            numToRead = subset['lenType'][ptNum]
-        else:
-            fileNum = 0
-            fileOff = 0
-            numToRead = nPart[ptNum]
-
-        result['count'] = numToRead
-
-        if not numToRead:
-            # print('warning: no particles of requested type, empty return.')
-            return result
-
-        # find a chunk with this particle type
-        i = 1
-        while gName not in f:
-            f = h5py.File(snapPath(basePath, snapNum, i), 'r')
-            i += 1
-
-        # if fields not specified, load everything
-        if not fields:
-            fields = list(f[gName].keys())
-
-        for i, field in enumerate(fields):
-            # verify existence
-            if field not in f[gName].keys():
-                raise Exception("Particle type ["+str(ptNum)+"] does not have field ["+field+"]")
-
-            # replace local length with global
-            shape = list(f[gName][field].shape)
-            shape[0] = numToRead
-
-            # multi-dimensional index slice load
-            if mdi is not None and mdi[i] is not None:
-                if len(shape) != 2:
-                    raise Exception("Read error: mdi requested on non-2D field ["+field+"]")
-                shape = [shape[0]]
-
-            # allocate within return dict
-            if field not in result:
-                dtype = f[gName][field].dtype
-                if dtype == np.float64 and float32: dtype = np.float32
-                result[field] = np.zeros(shape, dtype=dtype)
-
-    # loop over chunks
-    wOffset = 0 if field+'_write_offset' not in result else result[field+'_write_offset']
-    origNumToRead = numToRead
-
-    while numToRead:
-        f = h5py.File(snapPath(basePath, snapNum, fileNum), 'r')
-
-        # no particles of requested type in this file chunk?
-        if gName not in f:
-            f.close()
-            fileNum += 1
-            fileOff  = 0
-            continue
-
-        # set local read length for this file chunk, truncate to be within the local size
-        numTypeLocal = f['Header'].attrs['NumPart_ThisFile'][ptNum]
-
-        numToReadLocal = numToRead
-
-        if fileOff + numToReadLocal > numTypeLocal:
-            numToReadLocal = int(numTypeLocal - fileOff)
-
-        #print('['+str(fileNum).rjust(3)+'] off='+str(fileOff)+' read ['+str(numToReadLocal)+\
-        #      '] of ['+str(numTypeLocal)+'] remaining = '+str(numToRead-numToReadLocal), flush=True)
-
-        # define slice in destination array
-        out_slice = np.s_[wOffset:wOffset+numToReadLocal]
-
-        # loop over each requested field for this particle type and load
-        for i, field in enumerate(fields):
-            # define hyperslab in source file
-            source_slice = np.s_[fileOff:fileOff+numToReadLocal]
-            if mdi is not None and mdi[i] is not None:
-                source_slice = np.s_[fileOff:fileOff+numToReadLocal, mdi[i]]
-
-            #result[field][out_slice] = f[gName][field][source_slice]
-            f[gName][field].read_direct(result[field], source_sel=source_slice, dest_sel=out_slice)
-
-        wOffset   += numToReadLocal
-        numToRead -= numToReadLocal
-        fileNum   += 1
-        fileOff    = 0  # start at beginning of all file chunks other than the first
-
-        f.close()
-
-    # verify we read the correct number
-    if origNumToRead != wOffset:
-        raise Exception("Read ["+str(wOffset)+"] particles, but was expecting ["+str(origNumToRead)+"]")
-
-    # only a single field? then return the array instead of a single item dict
-    if sq and len(fields) == 1:
-        return result[fields[0]]
-
-    return result
-
-
-def getSnapOffsets(basePath, snapNum, id, type):
-    """ Compute offsets within snapshot for a particular group/subgroup. """
-    r = {}
-
-    # old or new format
-    if 'fof_subhalo' in gcPath(basePath, snapNum):
-        # use separate 'offsets_nnn.hdf5' files
-        with h5py.File(offsetPath(basePath, snapNum), 'r') as f:
-            groupFileOffsets = f['FileOffsets/'+type][()]
-            r['snapOffsets'] = np.transpose(f['FileOffsets/SnapByType'][()])  # consistency
-    else:
-        # load groupcat chunk offsets from header of first file
-        with h5py.File(gcPath(basePath, snapNum), 'r') as f:
-            groupFileOffsets = f['Header'].attrs['FileOffsets_'+type]
-            r['snapOffsets'] = f['Header'].attrs['FileOffsets_Snap']
-
-    # calculate target groups file chunk which contains this id
-    groupFileOffsets = int(id) - groupFileOffsets
-    fileNum = np.max(np.where(groupFileOffsets >= 0))
-    groupOffset = groupFileOffsets[fileNum]
-
-    # load the length (by type) of this group/subgroup from the group catalog
-    with h5py.File(gcPath(basePath, snapNum, fileNum), 'r') as f:
-        r['lenType'] = f[type][type+'LenType'][groupOffset, :]
-
-    # old or new format: load the offset (by type) of this group/subgroup within the snapshot
-    if 'fof_subhalo' in gcPath(basePath, snapNum):
-        with h5py.File(offsetPath(basePath, snapNum), 'r') as f:
-            r['offsetType'] = f[type+'/SnapByType'][id, :]
-
-            # add TNG-Cluster specific offsets if present
-            if 'OriginalZooms' in f:
-                for key in f['OriginalZooms']:
-                    r[key] = f['OriginalZooms'][key][()] 
-    else:
-        with h5py.File(gcPath(basePath, snapNum, fileNum), 'r') as f:
-            r['offsetType'] = f['Offsets'][type+'_SnapByType'][groupOffset, :]
-
-    return r
-
-
-def loadSubhalo(basePath, snapNum, id, partType, fields=None):
-    """ Load all particles/cells of one type for a specific subhalo
-        (optionally restricted to a subset fields). """
-    # load subhalo length, compute offset, call loadSubset
-    subset = getSnapOffsets(basePath, snapNum, id, "Subhalo")
-    return loadSubset(basePath, snapNum, partType, fields, subset=subset)
-
-
-def loadHalo(basePath, snapNum, id, partType, fields=None):
-    """ Load all particles/cells of one type for a specific halo
-        (optionally restricted to a subset fields). """
-    # load halo length, compute offset, call loadSubset
-    subset = getSnapOffsets(basePath, snapNum, id, "Group")
-    return loadSubset(basePath, snapNum, partType, fields, subset=subset)
-
-
-def loadOriginalZoom(basePath, snapNum, id, partType, fields=None):
-    """ Load all particles/cells of one type corresponding to an
-        original (entire) zoom simulation. TNG-Cluster specific.
-        (optionally restricted to a subset fields). """
-    # load fuzz length, compute offset, call loadSubset                                                                     
-    subset = getSnapOffsets(basePath, snapNum, id, "Group")
-
-    # identify original halo ID and corresponding index
-    halo = loadSingle(basePath, snapNum, haloID=id)
-    assert 'GroupOrigHaloID' in halo, 'Error: loadOriginalZoom() only for the TNG-Cluster simulation.'
-    orig_index = np.where(subset['HaloIDs'] == halo['GroupOrigHaloID'])[0][0]
-
-    # (1) load all FoF particles/cells
-    subset['lenType'] = subset['GroupsTotalLengthByType'][orig_index, :]
-    subset['offsetType'] = subset['GroupsSnapOffsetByType'][orig_index, :]
-
-    data1 = loadSubset(basePath, snapNum, partType, fields, subset=subset)
-
-    # (2) load all non-FoF particles/cells
-    subset['lenType'] = subset['OuterFuzzTotalLengthByType'][orig_index, :]
-    subset['offsetType'] = subset['OuterFuzzSnapOffsetByType'][orig_index, :]
-
-    data2 = loadSubset(basePath, snapNum, partType, fields, subset=subset)
-
-    # combine and return
-    if isinstance(data1, np.ndarray):
-        # protect against empty data
-        if isinstance(data2, dict):
-            return data1
-        return np.concatenate((data1,data2), axis=0)
-    
-    # protect against empty data
-    if data1["count"] == 0:
-        return data2
-    elif data2["count"] == 0:
-        return data1
-    
-    data = {'count':data1['count']+data2['count']}
-    for key in data1.keys():
-        if key == 'count': continue
-        data[key] = np.concatenate((data1[key],data2[key]), axis=0)
-    return data
-
+""" Illustris Simulation: Public Data Release.
+snapshot.py: File I/O related to the snapshot files. """
+from __future__ import print_function
+
+import numpy as np
+import six
+from functools import partial
+from os import stat
+from os.path import dirname, isfile, join
+from tempfile import TemporaryDirectory
+
+from .util import partTypeNum, partTypeWhere, cachedArrays, parallelMap, numProcs, sharedZeros, sharedSpec, \
+                  openShared, whereFields, whereMask, openFile, simulation
+from .groupcat import loadSingle, loadHeader, loadOffsets
+
+def snapPath(basePath, snapNum, chunkNum=0):
+    """ Return absolute path to a snapshot HDF5 file (modify as needed). """
+    snapPath = basePath + '/snapdir_' + str(snapNum).zfill(3) + '/'
+    filePath1 = snapPath + 'snap_' + str(snapNum).zfill(3) + '.' + str(chunkNum) + '.hdf5'
+    filePath2 = filePath1.replace('/snap_', '/snapshot_')
+
+    # the naming scheme is detected once per snapshot, see util.Simulation
+    return simulation(basePath).resolve(('snap', snapNum), [filePath1, filePath2]) or filePath2
+
+def getNumPart(header):
+    """ Calculate number of particles of all types given a snapshot header. """
+    if 'NumPart_Total_HighWord' not in header:
+        return np.int64(header['NumPart_Total']) # new uint64 convention
+
+    nTypes = 6
+
+    nPart = np.zeros(nTypes, dtype=np.int64)
+    for j in range(nTypes):
+        nPart[j] = header['NumPart_Total'][j] | (np.int64(header['NumPart_Total_HighWord'][j]) << 32)
+
+    return nPart
+
+
+def _sourceStamp(basePath, snapNum):
+    """ Cheap fingerprint (size and mtime of the first chunk) used to validate a sidecar index. """
+    st = stat(snapPath(basePath, snapNum))
+    return np.array([st.st_size, st.st_mtime_ns], dtype=np.int64)
+
+
+def _readIndex(f):
+    """ Load a chunk index from its (open) sidecar file. """
+    index = {'header'  : dict(f['Header'].attrs.items()),
+             'lenType' : f['NumPart_ThisFile'][()],
+             'fields'  : {}}
+
+    for ptNum in range(index['lenType'].shape[1]):
+        gName = "PartType" + str(ptNum)
+        if gName not in f:
+            continue
+        index['fields'][ptNum] = {field: (f[gName][field].shape[1:], f[gName][field].dtype)
+                                  for field in f[gName].attrs['FieldOrder']}
+
+    return index
+
+
+def _writeIndex(f, index):
+    """ Save a chunk index into its (open, empty) sidecar file. """
+    header = f.create_group('Header')
+    for key, value in index['header'].items():
+        header.attrs[key] = value
+    f['NumPart_ThisFile'] = index['lenType']
+
+    # each field is stored as an empty dataset carrying the shape and dtype of the original
+    for ptNum, fieldInfo in index['fields'].items():
+        g = f.create_group("PartType" + str(ptNum))
+        g.attrs['FieldOrder'] = list(fieldInfo.keys())
+        for field, (shape, dtype) in fieldInfo.items():
+            g.create_dataset(field, shape=(0,) + tuple(shape), dtype=dtype)
+
+
+def _buildIndex(basePath, snapNum):
+    """ Scan the headers of all file chunks of a snapshot and collect the chunk index. """
+    with openFile(snapPath(basePath, snapNum)) as f:
+        header = dict(f['Header'].attrs.items())
+
+    numFiles = int(header['NumFilesPerSnapshot'])
+    nTypes = len(header['NumPart_ThisFile'])
+
+    index = {'header'  : header,
+             'lenType' : np.zeros((numFiles, nTypes), dtype=np.int64),
+             'fields'  : {}}
+
+    for i in range(numFiles):
+        with openFile(snapPath(basePath, snapNum, i)) as f:
+            index['lenType'][i, :] = f['Header'].attrs['NumPart_ThisFile']
+
+            # record shape (excluding the particle dimension) and dtype of all fields, from the first
+            # chunk which contains any particles of each type
+            for ptNum in range(nTypes):
+                gName = "PartType" + str(ptNum)
+                if ptNum in index['fields'] or gName not in f:
+                    continue
+
+                index['fields'][ptNum] = {field: (f[gName][field].shape[1:], f[gName][field].dtype)
+                                          for field in f[gName].keys()}
+
+    return index
+
+
+def loadIndex(basePath, snapNum, cache=True):
+    """ Return the chunk index of a snapshot: its header, the number of particles of each type in every
+        file chunk, their cumulative offsets, and the shape and dtype of every field of each type.
+        The index is built once by scanning the chunk headers, and then kept in memory as well as in a
+        sidecar file (see util.cachePath), such that loads never need to probe the snapshot headers.
+        If cache is False, always rebuild the index (e.g. after the snapshot files have changed). """
+    key = ('index', snapNum)
+    sim = simulation(basePath)
+
+    if cache and key in sim.values:
+        return sim.values[key]
+
+    index = cachedArrays(basePath, 'snap_index_%03d.hdf5' % snapNum, lambda: _sourceStamp(basePath, snapNum),
+                         lambda f: _writeIndex(f, _buildIndex(basePath, snapNum)), cache, read=_readIndex)
+
+    # derived quantities: total counts and cumulative offsets of each chunk, per type
+    index['numFiles'] = index['lenType'].shape[0]
+    index['numPart'] = getNumPart(index['header'])
+    index['offsetType'] = np.zeros((index['numFiles'] + 1, index['lenType'].shape[1]), dtype=np.int64)
+    index['offsetType'][1:, :] = np.cumsum(index['lenType'], axis=0)
+
+    sim.values[key] = index
+
+    return index
+
+
+def _chunkSlices(index, ptNum, offset, length):
+    """ Split the global range [offset, offset+length) of particles of one type into the hyperslabs
+        of the file chunks which contain it. Return a list of (fileNum, fileOff, num, wOffset) tuples,
+        where wOffset is the position of each piece relative to the start of the range. """
+    slices = []
+
+    # starting file chunk and starting file chunk offset
+    fileNum = np.searchsorted(index['offsetType'][:-1, ptNum], offset, side='right') - 1
+    fileOff = offset - index['offsetType'][fileNum, ptNum]
+    wOffset = 0
+
+    while wOffset < length:
+        if fileNum >= index['numFiles']:
+            raise Exception("Requested particles ["+str(offset)+"-"+str(offset+length)+"] beyond end of snapshot.")
+
+        # set local read length for this file chunk, truncate to be within the local size
+        numToReadLocal = int(min(length - wOffset, index['lenType'][fileNum, ptNum] - fileOff))
+
+        # no particles of requested type in this file chunk?
+        if numToReadLocal > 0:
+            slices.append((int(fileNum), int(fileOff), numToReadLocal, int(wOffset)))
+            wOffset += numToReadLocal
+
+        fileNum += 1
+        fileOff  = 0  # start at beginning of all file chunks other than the first
+
+    return slices
+
+
+def _typeWhere(index, partType, where):
+    """ Combine a where argument with the condition selecting a logical particle type (stars or wind)
+        within its numeric type, if any, and if the snapshot has the field to tell them apart. """
+    typeCondition = partTypeWhere(partType)
+
+    if typeCondition is None or typeCondition[0] not in index['fields'].get(partTypeNum(partType), {}):
+        return where
+
+    if where is None:
+        return [typeCondition]
+
+    return [typeCondition] + ([where] if isinstance(where, tuple) else list(where))
+
+
+def _allocate(index, ptNum, fields, mdi, float32, numToRead, result, shared=False):
+    """ Verify the requested fields of a particle type and allocate their arrays of length numToRead
+        within result (unless already present), in shared memory if shared (see util.sharedZeros), such
+        that worker processes can read into them. Return the list of fields (all, if none given). """
+    fieldInfo = index['fields'][ptNum]
+
+    # if fields not specified, load everything
+    if not fields:
+        fields = list(fieldInfo.keys())
+
+    for i, field in enumerate(fields):
+        # verify existence (as stored, or derived)
+        derived = _derivedField(ptNum, field)
+        if field in fieldInfo:
+            shapeTail, dtype = fieldInfo[field]
+        elif derived is not None:
+            shapeTail, dtype = derived['shape'], derived['dtype']
+        else:
+            raise Exception("Particle type ["+str(ptNum)+"] does not have field ["+field+"]")
+
+        # replace local length with global
+        shape = [numToRead] + list(shapeTail)
+
+        # multi-dimensional index slice load
+        if mdi is not None and mdi[i] is not None:
+            if len(shape) != 2:
+                raise Exception("Read error: mdi requested on non-2D field ["+field+"]")
+            shape = [shape[0]]
+
+        # allocate within return dict
+        if field not in result:
+            if dtype == np.float64 and float32: dtype = np.float32
+            result[field] = sharedZeros(shape, dtype) if shared else np.zeros(shape, dtype=dtype)
+
+    return fields
+
+
+derivedFields = dict()
+
+def registerField(name, deps, func, partTypes=None, shape=(), dtype=np.float32, scaling=(0, 0)):
+    """ Register a derived field, which can then be requested from loadSubset() (and all other loaders)
+        like any field stored in the snapshot. It is computed file chunk by file chunk, as
+        func(data, ctx), where data is a dict with the fields deps of the particles of that piece, and
+        ctx a dict with basePath, snapNum, ptNum, the snapshot header, the global index (within this
+        partType) 'offset' of the first particle of the piece, its 'count', and the params passed to the
+        loader (e.g. 'center'). Only the result is kept, so deps are never allocated at full length.
+        partTypes restricts the field to some particle types, shape and dtype describe one value, and
+        scaling gives its (a, h) exponents for conversion to physical units (see loadSubset). """
+    derivedFields[name] = {'deps'      : list(deps),
+                           'func'      : func,
+                           'partTypes' : None if partTypes is None else [partTypeNum(pt) for pt in partTypes],
+                           'shape'     : tuple(shape),
+                           'dtype'     : dtype,
+                           'scaling'   : scaling}
+
+
+def _derivedField(ptNum, field):
+    """ Return the registered derived field available for this particle type, or None. """
+    derived = derivedFields.get(field)
+    if derived is None or (derived['partTypes'] is not None and ptNum not in derived['partTypes']):
+        return None
+    return derived
+
+
+def _temperature(data, ctx):
+    """ Gas temperature [K] from specific internal energy [(km/s)^2] and electron abundance. """
+    hydrogenMassFrac = 0.76
+    gamma = 5.0 / 3.0
+    mu = 4.0 / (1 + 3 * hydrogenMassFrac + 4 * hydrogenMassFrac * data['ElectronAbundance']) * 1.672622e-24
+    return (gamma - 1.0) * data['InternalEnergy'] / 1.380650e-16 * 1e10 * mu
+
+
+def _radius(data, ctx):
+    """ Distance [ckpc/h] from params['center'], accounting for periodicity. """
+    if ctx.get('center') is None:
+        raise Exception("Derived field [Radius] requires params={'center': ...}")
+    dx = _periodicDist(data['Coordinates'], np.asarray(ctx['center']), ctx['header']['BoxSize'])
+    return np.sqrt((dx.astype(np.float64) ** 2).sum(axis=1))
+
+
+registerField('Temperature', ['InternalEnergy', 'ElectronAbundance'], _temperature, partTypes=['gas'])
+registerField('Radius', ['Coordinates'], _radius, scaling=(1, -1))
+
+
+# (a, h) exponents converting code units to physical ones, for files without a_scaling/h_scaling attributes
+unitScalings = {'Coordinates': (1, -1), 'Velocities': (0.5, 0), 'Masses': (0, -1), 'Density': (-3, 2),
+                'SubfindHsml': (1, -1), 'SubfindDensity': (-3, 2), 'SubfindDMDensity': (-3, 2),
+                'StellarHsml': (1, -1), 'BH_Mass': (0, -1), 'BH_Hsml': (1, -1), 'BH_Density': (-3, 2),
+                'GFM_InitialMass': (0, -1), 'GFM_WindHostHaloMass': (0, -1), 'Potential': (-1, 0),
+                'MagneticField': (-2, 1)}
+
+# dimensionless fields, and those stored in physical units already
+unitScalings.update({field: (0, 0) for field in
+                     ['StarFormationRate', 'ElectronAbundance', 'NeutralHydrogenAbundance', 'InternalEnergy',
+                      'GFM_Metallicity', 'GFM_Metals', 'GFM_MetalsTagged', 'GFM_StellarFormationTime',
+                      'GFM_StellarPhotometrics', 'GFM_CoolingRate', 'GFM_AGNRadiation', 'GFM_WindDMVelDisp',
+                      'SubfindVelDisp', 'BH_Mdot']})
+
+def _unitScaling(dset, field):
+    """ Return the (a, h) exponents converting a field from code (comoving, h-scaled) units into physical
+        ones, from the attributes of its dataset, or else from unitScalings. """
+    if 'a_scaling' in dset.attrs and 'h_scaling' in dset.attrs:
+        return dset.attrs['a_scaling'], dset.attrs['h_scaling']
+    if field in unitScalings:
+        return unitScalings[field]
+    if dset.dtype.kind in 'iub':
+        return 0, 0 # counts, flags and IDs
+
+    raise Exception("Unknown unit scaling of field ["+field+"], cannot convert to physical units")
+
+
+def _readChunk(basePath, snapNum, gName, fields, mdi, result, pieces, params=None):
+    """ Read hyperslabs of all fields from one file chunk, each directly into its slice of the result
+        arrays. pieces is a list of (fileNum, fileOff, num, wOffset) tuples, all for the same chunk.
+        Derived fields (see registerField) are computed piece by piece from their dependencies. If
+        params['physical'] is set, all fields are converted to physical units in place. """
+    numRead = 0
+
+    index = loadIndex(basePath, snapNum)
+    ptNum = int(gName[len("PartType"):])
+    fieldInfo = index['fields'].get(ptNum, {})
+    physical = params is not None and params.get('physical')
+
+    ctx = dict(params or {}, basePath=basePath, snapNum=snapNum, ptNum=ptNum, header=index['header'])
+
+    with openFile(snapPath(basePath, snapNum, pieces[0][0])) as f:
+        for fileNum, fileOff, numToReadLocal, wOffset in pieces:
+            deps = {} # dependencies of derived fields, read once per piece
+            ctx['offset'] = index['offsetType'][fileNum, ptNum] + fileOff
+            ctx['count'] = numToReadLocal
+
+            # loop over each requested field for this particle type and load
+            for i, field in enumerate(fields):
+                mdiIndex = mdi[i] if mdi is not None else None
+
+                # define slice in destination array
+                wStart = wOffset + result.get(field+'_write_offset', 0)
+                out_slice = np.s_[wStart:wStart+numToReadLocal]
+
+                # define hyperslab in source file
+                source_slice = np.s_[fileOff:fileOff+numToReadLocal]
+                if mdiIndex is not None:
+                    source_slice = np.s_[fileOff:fileOff+numToReadLocal, mdiIndex]
+
+                if field in fieldInfo:
+                    f[gName][field].read_direct(result[field], source_sel=source_slice, dest_sel=out_slice)
+                    scaling = _unitScaling(f[gName][field], field) if physical else None
+                else:
+                    derived = _derivedField(ptNum, field)
+                    for dep in derived['deps']:
+                        if dep not in deps:
+                            deps[dep] = f[gName][dep][fileOff:fileOff+numToReadLocal]
+
+                    value = derived['func'](deps, ctx)
+                    if mdiIndex is not None:
+                        value = value[:, mdiIndex]
+
+                    result[field][out_slice] = value
+                    scaling = derived['scaling']
+
+                # convert to physical units in place
+                if physical:
+                    factor = index['header']['Time'] ** scaling[0] * index['header']['HubbleParam'] ** scaling[1]
+                    if factor != 1.0:
+                        result[field][out_slice] *= factor
+
+            numRead += numToReadLocal
+
+    return numRead
+
+
+def _readShared(basePath, snapNum, gName, targets, physical, pieces):
+    """ Worker process target for _readPieces(): read stored fields from one file chunk directly into
+        their shared result arrays, given by targets, a list of (field, mdi, sharedSpec, write offset). """
+    result = {}
+    for field, _, spec, wOffset in targets:
+        result[field] = openShared(spec)
+        result[field+'_write_offset'] = wOffset
+
+    return _readChunk(basePath, snapNum, gName, [target[0] for target in targets],
+                      [target[1] for target in targets], result, pieces, {'physical': physical})
+
+
+def _readPieces(basePath, snapNum, gName, fields, mdi, result, pieces, nThreads=1, params=None):
+    """ Read a list of chunk hyperslabs (see _chunkSlices), opening each file chunk only once. Since the
+        destination of each piece is known in advance, chunks can be read in any order. If nThreads > 1,
+        that many worker processes read the file chunks concurrently, each directly into the result
+        arrays allocated in shared memory (see util.sharedZeros), so memory use is that of the serial
+        read. Derived fields, and fields of arrays not in shared memory (e.g. given by the caller), are
+        then read here. Return the total number of particles read. """
+    byFile = {}
+    for piece in pieces:
+        byFile.setdefault(piece[0], []).append(piece)
+
+    if numProcs(nThreads) <= 1 or len(byFile) <= 1:
+        func = partial(_readChunk, basePath, snapNum, gName, fields, mdi, result, params=params)
+        return sum(map(func, byFile.values()))
+
+    ptNum = int(gName[len("PartType"):])
+    fieldInfo = loadIndex(basePath, snapNum)['fields'].get(ptNum, {})
+    targets = []
+    rest = []
+
+    for i, field in enumerate(fields):
+        mdiIndex = mdi[i] if mdi is not None else None
+        spec = sharedSpec(result[field]) if field in fieldInfo else None
+        if spec is not None:
+            targets.append((field, mdiIndex, spec, result.get(field+'_write_offset', 0)))
+        else:
+            rest.append((field, mdiIndex))
+
+    numRead = 0
+
+    if targets:
+        physical = params is not None and bool(params.get('physical'))
+        func = partial(_readShared, basePath, snapNum, gName, targets, physical)
+        numRead = sum(parallelMap(func, nThreads, list(byFile.values())))
+
+    if rest:
+        func = partial(_readChunk, basePath, snapNum, gName, [field for field, _ in rest],
+                       [mdiIndex for _, mdiIndex in rest], result, params=params)
+        numRead = sum(map(func, byFile.values()))
+
+    return numRead
+
+
+def loadSubset(basePath, snapNum, partType, fields=None, subset=None, mdi=None, sq=True, float32=False, result=None,
+               nThreads=1, where=None, physical=False, params=None):
+    """ Load a subset of fields for all particles/cells of a given partType.
+        If offset and length specified, load only that subset of the partType.
+        If mdi is specified, must be a list of integers of the same length as fields,
+        giving for each field the multi-dimensional index (on the second dimension) to load.
+          For example, fields=['Coordinates', 'Masses'] and mdi=[1, None] returns a 1D array
+          of y-Coordinates only, together with Masses.
+        If sq is True, return a numpy array instead of a dict if len(fields)==1.
+        If float32 is True, load any float64 datatype arrays directly as float32 (save memory). 
+        If result is not None, should be a dict containing pre-allocated ndarrays for each 
+        requested field. And optionally: {field}_write_offset specifying the starting write offset 
+        to place the result within result[{field}].
+        If nThreads > 1, read that many file chunks concurrently in worker processes (see
+          util.parallelMap), each directly into its slice of the result, which is then allocated in
+          shared memory (see util.sharedZeros): identical output and memory use to the serial read.
+        If where is specified, load only particles/cells satisfying the given condition(s), for example
+          where=('StarFormationRate', '>', 0), or a list of such conditions (see util.whereMask).
+          The matches of each block are first counted, reading only the fields the condition needs,
+          and then the blocks with matches are read again, compacting their matching rows into the
+          result, so memory use follows the number of matches.
+        The logical types 'stars' and 'wind' select only the type 4 particles with positive and
+          non-positive GFM_StellarFormationTime, respectively, in the same way (use 4 for both).
+        Fields (and where conditions) may include derived fields, such as 'Temperature' or 'Radius'
+          (see registerField), which are computed chunk by chunk. params is a dict passed on to their
+          computation, for example params={'center': pos} for 'Radius'.
+        If physical is True, convert all fields from comoving code units into physical ones, in place
+          (using the a_scaling and h_scaling attributes of each dataset, or else unitScalings)."""
+    if result is None: result = {}
+    params = dict(params or {}, physical=physical)
+
+    ptNum = partTypeNum(partType)
+    gName = "PartType" + str(ptNum)
+
+    # make sure fields is not a single element
+    if isinstance(fields, six.string_types):
+        fields = [fields]
+
+    # chunk index replaces all header probing
+    index = loadIndex(basePath, snapNum)
+
+    # decide global read size and global starting offset
+    if subset:
+        offset = subset['offsetType'][ptNum]
+        numToRead = subset['lenType'][ptNum]
+    else:
+        offset = 0
+        numToRead = index['numPart'][ptNum]
+
+    result['count'] = numToRead
+
+    if not numToRead:
+        # print('warning: no particles of requested type, empty return.')
+        return result
+
+    where = _typeWhere(index, partType, where)
+
+    if where is not None:
+        # first pass: count the matches of each block, reading only the fields the condition needs
+        blockSize = 4194304
+        blockStarts = np.arange(offset, offset + numToRead, blockSize, dtype=np.int64)
+        blockLengths = np.minimum(blockSize, offset + numToRead - blockStarts)
+        counts = np.array([np.count_nonzero(whereMask(where, data)) for data, _ in
+                           _iterRanges(basePath, snapNum, ptNum, whereFields(where), blockStarts, blockLengths,
+                                       blockSize=blockSize, nThreads=nThreads, params=params)], dtype=np.int64)
+
+        result['count'] = counts.sum()
+
+        if not result['count']:
+            return result
+
+        # second pass: read the blocks with matches again, and compact their matching rows into place
+        fields = _allocate(index, ptNum, fields, mdi, float32, result['count'], result)
+        w = np.where(counts > 0)[0]
+        numWritten = 0
+
+        blocks = zip(_iterRanges(basePath, snapNum, ptNum, whereFields(where), blockStarts[w], blockLengths[w],
+                                 blockSize=blockSize, nThreads=nThreads, params=params),
+                     _iterRanges(basePath, snapNum, ptNum, fields, blockStarts[w], blockLengths[w], mdi, float32,
+                                 blockSize=blockSize, nThreads=nThreads, params=params))
+
+        for (whereData, _), (data, _) in blocks:
+            mask = whereMask(where, whereData)
+            numMatch = np.count_nonzero(mask)
+
+            for field in fields:
+                wOffset = result.get(field+'_write_offset', 0) + numWritten
+                result[field][wOffset:wOffset+numMatch] = data[field][mask]
+            numWritten += numMatch
+
+        if sq and len(fields) == 1:
+            return result[fields[0]]
+
+        return result
+
+    fields = _allocate(index, ptNum, fields, mdi, float32, numToRead, result, shared=numProcs(nThreads) > 1)
+
+    # loop over chunks
+    pieces = _chunkSlices(index, ptNum, offset, numToRead)
+    numRead = _readPieces(basePath, snapNum, gName, fields, mdi, result, pieces, nThreads, params)
+
+    # verify we read the correct number
+    if numToRead != numRead:
+        raise Exception("Read ["+str(numRead)+"] particles, but was expecting ["+str(numToRead)+"]")
+
+    # only a single field? then return the array instead of a single item dict
+    if sq and len(fields) == 1:
+        return result[fields[0]]
+
+    return result
+
+
+def _splitRanges(starts, lengths, edges):
+    """ Split ranges [start, start+length) at the given sorted edges (which must enclose all ranges).
+        Return, for each non-empty piece, the bin i such that edges[i] <= piece < edges[i+1], its start
+        and length, and the index of the range it came from. """
+    ends = starts + lengths
+    first = np.searchsorted(edges, starts, side='right') - 1
+    last = np.searchsorted(edges, ends - 1, side='right') - 1
+    numPieces = np.maximum(last - first + 1, 0)
+
+    source = np.repeat(np.arange(starts.size), numPieces)
+    bins = np.repeat(first - (np.cumsum(numPieces) - numPieces), numPieces) + np.arange(numPieces.sum())
+
+    pieceStarts = np.maximum(starts[source], edges[bins])
+    pieceLengths = np.minimum(ends[source], edges[bins + 1]) - pieceStarts
+
+    w = np.where(pieceLengths > 0)[0]
+    return bins[w], pieceStarts[w], pieceLengths[w], source[w]
+
+
+def _iterRanges(basePath, snapNum, ptNum, fields, starts, lengths, mdi=None, float32=False,
+                blockSize=4194304, nThreads=1, params=None):
+    """ Read a sorted list of disjoint particle ranges of one type, concatenated, in batches of at most
+        blockSize particles (each opening every file chunk at most once). Yield each batch as a dict of
+        field arrays, together with the (sorted) global index of each of its particles. """
+    index = loadIndex(basePath, snapNum)
+    gName = "PartType" + str(ptNum)
+
+    starts = np.asarray(starts, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    bufOffsets = np.cumsum(lengths) - lengths
+    numToRead = int(lengths.sum())
+
+    # split at file chunk boundaries, then split the concatenated buffer into batches
+    chunkEdges = index['offsetType'][:, ptNum]
+    fileNums, pieceStarts, pieceLengths, source = _splitRanges(starts, lengths, chunkEdges)
+    pieceBufOffsets = bufOffsets[source] + (pieceStarts - starts[source])
+
+    batchEdges = np.arange(0, numToRead + blockSize, blockSize, dtype=np.int64)
+    batches, wOffsets, numLocal, source = _splitRanges(pieceBufOffsets, pieceLengths, batchEdges)
+    fileNums = fileNums[source]
+    globalStarts = pieceStarts[source] + (wOffsets - pieceBufOffsets[source])
+    fileOffsets = globalStarts - chunkEdges[fileNums]
+
+    for batch in np.unique(batches):
+        w = np.where(batches == batch)[0]
+        batchStart = batchEdges[batch]
+        numToReadBatch = int(numLocal[w].sum())
+
+        result = {'count': numToReadBatch}
+        fields = _allocate(index, ptNum, fields, mdi, float32, numToReadBatch, result, shared=numProcs(nThreads) > 1)
+
+        pieces = list(zip(fileNums[w], fileOffsets[w], numLocal[w], wOffsets[w] - batchStart))
+        _readPieces(basePath, snapNum, gName, fields, mdi, result, pieces, nThreads, params)
+
+        rows = np.repeat(globalStarts[w] - (wOffsets[w] - batchStart), numLocal[w]) + np.arange(numToReadBatch)
+
+        yield result, rows
+
+
+def _loadRows(basePath, snapNum, ptNum, fields, rows, mdi=None, float32=False, maxGap=64,
+              blockSize=4194304, nThreads=1, result=None, params=None):
+    """ Load fields for the given sorted, unique global indices of particles of one type. Rows at most
+        maxGap apart are read together in one hyperslab (as in util.readRows), in batches of at most
+        blockSize particles, such that memory use follows the number of rows. The optional result dict
+        and params are as for loadSubset(). """
+    if result is None: result = {}
+
+    rows = np.asarray(rows, dtype=np.int64)
+    result['count'] = rows.size
+
+    if not rows.size:
+        return result
+
+    fields = _allocate(loadIndex(basePath, snapNum), ptNum, fields, mdi, float32, rows.size, result)
+
+    # split into runs wherever the gap between consecutive rows is large
+    breaks = np.where(np.diff(rows) > maxGap)[0] + 1
+    runStarts = rows[np.concatenate(([0], breaks))]
+    runEnds = rows[np.concatenate((breaks - 1, [rows.size - 1]))] + 1
+
+    for data, dataRows in _iterRanges(basePath, snapNum, ptNum, fields, runStarts, runEnds - runStarts,
+                                      mdi, float32, blockSize, nThreads, params):
+        i0 = np.searchsorted(rows, dataRows[0])
+        i1 = np.searchsorted(rows, dataRows[-1], side='right')
+        local = np.searchsorted(dataRows, rows[i0:i1])
+
+        for field in fields:
+            wOffset = result.get(field+'_write_offset', 0)
+            result[field][wOffset+i0:wOffset+i1] = data[field][local]
+
+    return result
+
+
+def iterSubset(basePath, snapNum, partType, fields=None, subset=None, mdi=None, float32=False,
+               blockSize=4194304, nThreads=1, where=None, physical=False, params=None):
+    """ Iterate over a subset of fields for all particles/cells of a given partType, in blocks of (at most)
+        blockSize particles, such that peak memory is set by blockSize instead of the total count.
+        Arguments subset, mdi, float32, nThreads, where, physical and params are as for loadSubset().
+        Each block is yielded as a dict of arrays, together with 'offset', the global index (within this
+        partType) of the first particle of the block, and 'count', the number of particles in the block.
+        With where (or for the logical types 'stars' and 'wind'), each block holds only the matching
+        particles of its range. """
+    ptNum = partTypeNum(partType)
+    gName = "PartType" + str(ptNum)
+    params = dict(params or {}, physical=physical)
+
+    # make sure fields is not a single element
+    if isinstance(fields, six.string_types):
+        fields = [fields]
+
+    index = loadIndex(basePath, snapNum)
+    where = _typeWhere(index, partType, where)
+
+    # decide global read size and global starting offset
+    if subset:
+        offset = subset['offsetType'][ptNum]
+        numToRead = subset['lenType'][ptNum]
+    else:
+        offset = 0
+        numToRead = index['numPart'][ptNum]
+
+    for blockStart in range(0, int(numToRead), int(blockSize)):
+        numToReadBlock = int(min(blockSize, numToRead - blockStart))
+
+        result = {'offset': offset + blockStart, 'count': numToReadBlock}
+        fields = _allocate(index, ptNum, fields, mdi, float32, numToReadBlock, result, shared=numProcs(nThreads) > 1)
+
+        # a block may span several file chunks
+        pieces = _chunkSlices(index, ptNum, offset + blockStart, numToReadBlock)
+
+        if where is None:
+            _readPieces(basePath, snapNum, gName, fields, mdi, result, pieces, nThreads, params)
+            yield result
+            continue
+
+        # evaluate the condition on this block, then keep only the matching particles
+        data = {'count': numToReadBlock}
+        whereData = _allocate(index, ptNum, whereFields(where), None, False, numToReadBlock, data,
+                              shared=numProcs(nThreads) > 1)
+        _readPieces(basePath, snapNum, gName, whereData, None, data, pieces, nThreads, params)
+        w = np.where(whereMask(where, data))[0]
+
+        _readPieces(basePath, snapNum, gName, fields, mdi, result, pieces, nThreads, params)
+        for field in fields:
+            result[field] = result[field][w]
+        result['count'] = w.size
+
+        yield result
+
+
+def loadSample(basePath, snapNum, partType, fields=None, fraction=0.01, seed=None, blockSize=1024, mdi=None,
+               sq=True, float32=False, nThreads=1, where=None, physical=False, params=None):
+    """ Load a reproducible random subsample of about fraction of all particles/cells of a given partType,
+        for quick looks, reading only the sampled data. The particles are divided into blocks of blockSize
+        consecutive particles, and those into equal strata of blocks, one per sampled block, so the
+        sample is spread evenly over all file chunks (and thus over the whole box). One block is picked at
+        random (with the given seed) from each stratum, and read contiguously: larger blocks read more
+        efficiently, smaller ones give a more random sample. The global index (within this partType) of
+        each sampled particle is returned as 'index'. Arguments mdi, sq, float32, nThreads, where, physical
+        and params are as for loadSubset(), with where applied to the sampled particles. If fraction is
+        zero, nothing is sampled. """
+    result = {}
+    params = dict(params or {}, physical=physical)
+
+    ptNum = partTypeNum(partType)
+    gName = "PartType" + str(ptNum)
+
+    # make sure fields is not a single element
+    if isinstance(fields, six.string_types):
+        fields = [fields]
+
+    index = loadIndex(basePath, snapNum)
+    where = _typeWhere(index, partType, where)
+    numPart = int(index['numPart'][ptNum])
+
+    # choose one block at random from each of numSample equal strata of the blocks
+    numBlocks = -(-numPart // blockSize)
+    numSample = int(min(max(round(fraction * numBlocks), 1 if fraction > 0 else 0), numBlocks))
+
+    rng = np.random.default_rng(seed)
+    strata = np.arange(numSample + 1, dtype=np.int64) * numBlocks // max(numSample, 1)
+    blocks = strata[:-1] + (rng.random(numSample) * np.diff(strata)).astype(np.int64)
+
+    starts = blocks * blockSize
+    lengths = np.minimum(starts + blockSize, numPart) - starts
+    numToRead = int(lengths.sum())
+
+    result['count'] = numToRead
+    result['index'] = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(numToRead)
+
+    if not numToRead:
+        return result
+
+    # blocks may span file chunks, and are read directly into their slices of the result
+    chunkEdges = index['offsetType'][:, ptNum]
+    fileNums, pieceStarts, pieceLengths, _ = _splitRanges(starts, lengths, chunkEdges)
+    pieces = list(zip(fileNums, pieceStarts - chunkEdges[fileNums], pieceLengths,
+                      np.cumsum(pieceLengths) - pieceLengths))
+
+    fields = _allocate(index, ptNum, fields, mdi, float32, numToRead, result, shared=numProcs(nThreads) > 1)
+    _readPieces(basePath, snapNum, gName, fields, mdi, result, pieces, nThreads, params)
+
+    if where is not None:
+        # keep only the sampled particles satisfying the condition
+        data = {'count': numToRead}
+        whereData = _allocate(index, ptNum, whereFields(where), None, False, numToRead, data,
+                              shared=numProcs(nThreads) > 1)
+        _readPieces(basePath, snapNum, gName, whereData, None, data, pieces, nThreads, params)
+        w = np.where(whereMask(where, data))[0]
+
+        for field in fields + ['index']:
+            result[field] = result[field][w]
+        result['count'] = w.size
+
+    # only a single field? then return the array instead of a single item dict
+    if sq and len(fields) == 1:
+        return result[fields[0]]
+
+    return result
+
+
+def _periodicDist(pos, center, boxSize):
+    """ Absolute separation, per axis, between positions and a center, in a periodic box of size boxSize
+        (non-periodic if boxSize is zero). """
+    dx = np.abs(pos - center)
+
+    if boxSize:
+        dx %= boxSize
+        dx = np.minimum(dx, boxSize - dx)
+
+    return dx
+
+
+def _buildSpatialIndex(basePath, snapNum, ptNum, blockSize):
+    """ Compute the bounding box of each block of blockSize consecutive particles of one type. Boxes are
+        stored as center and half-size, and are computed relative to the first particle of each block,
+        such that blocks which straddle the periodic boundary still have compact boxes. """
+    index = loadIndex(basePath, snapNum)
+    boxSize = index['header']['BoxSize']
+
+    numBlocks = int(np.ceil(index['numPart'][ptNum] / blockSize))
+    center = np.zeros((numBlocks, 3), dtype=np.float64)
+    halfSize = np.zeros((numBlocks, 3), dtype=np.float64)
+
+    for data in iterSubset(basePath, snapNum, ptNum, 'Coordinates', blockSize=blockSize*256):
+        pos = data['Coordinates'].astype(np.float64)
+        blockStarts = np.arange(0, data['count'], blockSize)
+        blockLengths = np.diff(np.append(blockStarts, data['count']))
+
+        # displacement of each particle from the first particle of its block
+        dx = pos - np.repeat(pos[blockStarts], blockLengths, axis=0)
+        if boxSize:
+            dx = (dx + boxSize/2) % boxSize - boxSize/2
+
+        lo = np.minimum.reduceat(dx, blockStarts, axis=0)
+        hi = np.maximum.reduceat(dx, blockStarts, axis=0)
+
+        w = np.s_[data['offset'] // blockSize : data['offset'] // blockSize + blockStarts.size]
+        center[w] = pos[blockStarts] + (lo + hi) / 2
+        halfSize[w] = (hi - lo) / 2
+
+    if boxSize:
+        center %= boxSize
+
+    return {'Center': center, 'HalfSize': halfSize}
+
+
+def loadSpatialIndex(basePath, snapNum, partType, blockSize=8192, cache=True):
+    """ Return the spatial index of one particle type of a snapshot: the bounding box (center and
+        half-size, accounting for periodicity) of each block of blockSize consecutive particles. Since
+        particles are stored ordered by group, subgroup, and then spatially, these boxes are compact.
+        Built once with a single pass over Coordinates, then kept in memory and in a sidecar file. """
+    ptNum = partTypeNum(partType)
+    key = ('spatialIndex', snapNum, ptNum, blockSize)
+    sim = simulation(basePath)
+
+    if cache and key in sim.values:
+        return sim.values[key]
+
+    sindex = cachedArrays(basePath, 'spatial_index_%03d_%d_%d.hdf5' % (snapNum, ptNum, blockSize),
+                          lambda: _sourceStamp(basePath, snapNum),
+                          lambda f: _buildSpatialIndex(basePath, snapNum, ptNum, blockSize), cache)
+    sindex['BlockSize'] = blockSize
+
+    sim.values[key] = sindex
+
+    return sindex
+
+
+def loadRegion(basePath, snapNum, center, partType, fields=None, radius=None, box=None, sq=True, blockSize=8192,
+               nThreads=1, where=None):
+    """ Load all particles/cells of one type within a sphere of the given radius, or within a box of the
+        given edge length(s) (scalar or 3-vector), centered on center (optionally restricted to a subset
+        fields). The periodic boundary is respected. Only the blocks of particles whose bounding boxes
+        (see loadSpatialIndex, with the given blockSize) intersect the region are read, and fields are
+        loaded for matches only. Optionally, also require where (see loadSubset) to hold.
+        If sq is True, return a numpy array instead of a dict if len(fields)==1. """
+    if (radius is None) == (box is None):
+        raise Exception("Must specify either radius or box (and not both).")
+
+    ptNum = partTypeNum(partType)
+
+    # make sure fields is not a single element
+    if isinstance(fields, six.string_types):
+        fields = [fields]
+
+    index = loadIndex(basePath, snapNum)
+    boxSize = index['header']['BoxSize']
+    numPart = index['numPart'][ptNum]
+
+    where = _typeWhere(index, partType, where)
+    selectFields = ['Coordinates'] + (whereFields(where) if where is not None else [])
+
+    center = np.asarray(center, dtype=np.float64)
+    extent = np.ones(3) * (radius if radius is not None else np.asarray(box, dtype=np.float64) / 2)
+
+    # candidate blocks: those whose bounding box intersects the region
+    sindex = loadSpatialIndex(basePath, snapNum, ptNum, blockSize)
+
+    gap = np.maximum(_periodicDist(sindex['Center'], center, boxSize) - sindex['HalfSize'], 0.0)
+    candidates = np.all(gap <= extent, axis=1)
+    if radius is not None:
+        candidates &= np.sum(gap**2, axis=1) <= radius**2
+
+    blocks = np.where(candidates)[0]
+
+    # merge consecutive blocks into particle ranges
+    firstBlock = np.diff(blocks, prepend=-2) > 1
+    lastBlock = np.append(firstBlock[1:], True)[:blocks.size]
+
+    rangeStarts = blocks[firstBlock] * blockSize
+    rangeEnds = np.minimum((blocks[lastBlock] + 1) * blockSize, numPart)
+
+    # exact selection on the coordinates of the candidate ranges only
+    rows = [np.zeros(0, dtype=np.int64)]
+
+    for data, dataRows in _iterRanges(basePath, snapNum, ptNum, selectFields, rangeStarts,
+                                      rangeEnds - rangeStarts, nThreads=nThreads):
+        dx = _periodicDist(data['Coordinates'].astype(np.float64), center, boxSize)
+
+        if radius is not None:
+            w = np.sum(dx**2, axis=1) <= radius**2
+        else:
+            w = np.all(dx <= extent, axis=1)
+
+        if where is not None:
+            w &= whereMask(where, data)
+
+        rows.append(dataRows[w])
+
+    # load requested fields for the matching particles
+    result = _loadRows(basePath, snapNum, ptNum, fields, np.concatenate(rows), nThreads=nThreads)
+
+    # only a single field? then return the array instead of a single item dict
+    if sq and result['count'] and fields is not None and len(fields) == 1:
+        return result[fields[0]]
+
+    return result
+
+
+def _idField(ptNum):
+    """ Name of the field holding the unique identifier of each particle of a type. """
+    return 'TracerID' if ptNum == partTypeNum('tracers') else 'ParticleIDs'
+
+
+def _buildIDIndex(f, basePath, snapNum, ptNum, bucketSize):
+    """ Sort all IDs of one particle type, keeping the global index of each, into the datasets
+        'ParticleIDs' and 'Index' of the open HDF5 file f. If there are more than bucketSize IDs, the
+        IDs are split by value into buckets of about half that size, bounded by the quantiles of a sample
+        (see loadSample). A single pass over the IDs appends each of them, with its index, to the
+        temporary file of its bucket (next to f, or in the system temporary directory if f is in memory),
+        and then each bucket is sorted in memory and written to its place, so that at most about
+        bucketSize IDs are held at once. """
+    idField = _idField(ptNum)
+    index = loadIndex(basePath, snapNum)
+    numPart = int(index['numPart'][ptNum])
+    dtype = index['fields'].get(ptNum, {}).get(idField, ((), np.uint64))[1]
+
+    # stored contiguous and uncompressed, such that it can be memory-mapped
+    sortedIDs = f.create_dataset('ParticleIDs', shape=(numPart,), dtype=dtype)
+    sortedIndex = f.create_dataset('Index', shape=(numPart,), dtype=np.int64)
+
+    if numPart <= bucketSize:
+        ids = loadSubset(basePath, snapNum, ptNum, fields=[idField], sq=False).get(idField, np.zeros(0, dtype))
+        order = np.argsort(ids, kind='stable')
+        sortedIDs[:] = ids[order]
+        sortedIndex[:] = order
+        return
+
+    numBuckets = 2 * int(np.ceil(numPart / bucketSize))
+    sample = loadSample(basePath, snapNum, ptNum, fields=[idField], fraction=min(1.0, 1000 * numBuckets / numPart),
+                        seed=0, blockSize=64, sq=False)[idField]
+    bounds = np.sort(sample)[np.linspace(0, sample.size, numBuckets + 1)[1:-1].astype(np.int64)]
+
+    recordType = np.dtype([('ID', dtype), ('Index', np.int64)])
+
+    with TemporaryDirectory(dir=None if f.driver == 'core' else dirname(f.filename)) as tmpDir:
+        bucketPaths = [join(tmpDir, 'bucket_%d' % i) for i in range(numBuckets)]
+
+        # scatter: records of each block, grouped by bucket (stably, so each bucket stays in index order)
+        for data in iterSubset(basePath, snapNum, ptNum, fields=[idField], blockSize=bucketSize):
+            buckets = np.searchsorted(bounds, data[idField], side='right')
+            order = np.argsort(buckets, kind='stable')
+            records = np.empty(order.size, dtype=recordType)
+            records['ID'] = data[idField][order]
+            records['Index'] = data['offset'] + order
+
+            counts = np.bincount(buckets, minlength=numBuckets)
+            starts = np.cumsum(counts) - counts
+            for i in np.nonzero(counts)[0]:
+                with open(bucketPaths[i], 'ab') as bf:
+                    records[starts[i]:starts[i]+counts[i]].tofile(bf)
+
+        # sort each bucket, which (being a range of ID values) has its place in the sorted index
+        start = 0
+        for path in bucketPaths:
+            if not isfile(path):
+                continue
+            records = np.fromfile(path, dtype=recordType)
+            records = records[np.argsort(records['ID'], kind='stable')]
+            sortedIDs[start:start+records.size] = records['ID']
+            sortedIndex[start:start+records.size] = records['Index']
+            start += records.size
+
+
+def loadIDIndex(basePath, snapNum, partType, cache=True, bucketSize=33554432):
+    """ Return the ID index of one particle type of a snapshot: all ParticleIDs (TracerID for tracers)
+        sorted, as 'ParticleIDs', together with the global index (within this partType) of each, as
+        'Index', such that np.searchsorted() maps IDs to particles. Built once with a single pass over
+        the IDs, sorting at most about bucketSize of them in memory at a time (see _buildIDIndex), then
+        kept in a sidecar file whose arrays are memory-mapped, so lookups read only the pages they touch.
+        If cache is False, always rebuild the index (in memory). """
+    ptNum = partTypeNum(partType)
+    key = ('idIndex', snapNum, ptNum)
+    sim = simulation(basePath)
+
+    if cache and key in sim.values:
+        return sim.values[key]
+
+    idIndex = cachedArrays(basePath, 'id_index_%03d_%d.hdf5' % (snapNum, ptNum),
+                           lambda: _sourceStamp(basePath, snapNum),
+                           lambda f: _buildIDIndex(f, basePath, snapNum, ptNum, bucketSize), cache)
+
+    sim.values[key] = idIndex
+
+    return idIndex
+
+
+def _matchIDs(sortedIDs, ids):
+    """ Find ids within the sorted array sortedIDs. Return the positions (in ids) of those present, and
+        the position of each within sortedIDs. """
+    ids = np.asarray(ids).astype(sortedIDs.dtype, copy=False) # never compare uint64 IDs via float64
+
+    if not sortedIDs.size:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    pos = np.minimum(np.searchsorted(sortedIDs, ids), sortedIDs.size - 1)
+    found = np.where(sortedIDs[pos] == ids)[0]
+
+    return found, pos[found]
+
+
+def loadByIDs(basePath, snapNum, partType, ids, fields=None, mdi=None, float32=False, nThreads=1, where=None):
+    """ Load a subset of fields for the particles/cells of a given partType with the given IDs (see
+        loadIDIndex), reading only the matching rows. Return a dict with arrays aligned with ids, and
+        'index', the global index (within this partType) of each particle, which is -1 (and its fields
+        zero) for IDs which are not present in this snapshot, or which do not satisfy where (as for
+        loadSubset, including the logical types 'stars' and 'wind'). 'count' is the number found. """
+    ptNum = partTypeNum(partType)
+
+    # make sure fields is not a single element
+    if isinstance(fields, six.string_types):
+        fields = [fields]
+
+    ids = np.asarray(ids).ravel()
+    index = loadIndex(basePath, snapNum)
+    where = _typeWhere(index, partType, where)
+
+    if not fields:
+        fields = list(index['fields'].get(ptNum, {}).keys())
+
+    # sorted lookup of all requested IDs at once
+    idIndex = loadIDIndex(basePath, snapNum, ptNum)
+    found, pos = _matchIDs(idIndex['ParticleIDs'], ids)
+
+    rows = np.full(ids.size, -1, dtype=np.int64)
+    rows[found] = idIndex['Index'][pos]
+
+    result = {'index': rows}
+    _allocate(index, ptNum, fields, mdi, float32, ids.size, result)
+
+    if found.size:
+        # read the matching rows once each (in storage order)
+        uniqueRows, inverse = np.unique(rows[found], return_inverse=True)
+        readFields = fields + [field for field in whereFields(where or []) if field not in fields]
+        data = _loadRows(basePath, snapNum, ptNum, readFields, uniqueRows,
+                         mdi + [None] * (len(readFields) - len(fields)) if mdi is not None else None,
+                         float32, nThreads=nThreads)
+
+        if where is not None:
+            keep = whereMask(where, data)[inverse]
+            rows[found[~keep]] = -1
+            found, inverse = found[keep], inverse[keep]
+
+        for field in fields:
+            result[field][found] = data[field][inverse]
+
+    result['count'] = found.size
+
+    return result
+
+
+def trackIDs(basePath, snapNums, partType, ids, fields=None, mdi=None, float32=False, nThreads=1):
+    """ Follow the particles/cells of a given partType with the given IDs through a list of snapshots
+        (see loadByIDs). Return a dict with 'snaps', 'index' of shape [len(snapNums), len(ids)], and each
+        field stacked in the same way, such that [i, j] refers to ids[j] in snapNums[i]. Particles absent
+        from a snapshot (e.g. gas cells which have since formed stars) have index -1 and zero fields. """
+    # make sure fields is not a single element
+    if isinstance(fields, six.string_types):
+        fields = [fields]
+
+    result = {'snaps': np.asarray(snapNums)}
+
+    for i, snapNum in enumerate(snapNums):
+        data = loadByIDs(basePath, snapNum, partType, ids, fields, mdi, float32, nThreads)
+
+        for field in ['index'] + [key for key in data if key not in ['count', 'index']]:
+            if field not in result:
+                result[field] = np.zeros((len(snapNums),) + data[field].shape, dtype=data[field].dtype)
+            result[field][i] = data[field]
+
+    return result
+
+
+def loadTracerParents(basePath, snapNum, subset=None, parentFields=None, parentTypes=('gas', 'stars', 'bhs'),
+                      mdi=None, float32=False, blockSize=4194304, nThreads=1):
+    """ Resolve the parent of each Monte Carlo tracer (of all, or of those in subset, e.g. one halo as
+        returned by getSnapOffsets), joining tracer ParentID against the ParticleIDs of parentTypes.
+        The ParentIDs are streamed in blocks of blockSize, and matched by sorted search: with subset
+        only against the parents within the same subset (so a per-halo join reads only that halo), and
+        otherwise against the persistent ID index of each parent type (see loadIDIndex). Return a dict
+        with arrays aligned with the tracers: 'ParentType' and 'ParentIndex', the global index of the
+        parent within its type (both -1 if no parent was found, e.g. outside subset), and each of
+        parentFields loaded for the parents (zero where the parent type lacks the field). """
+    ptTracer = partTypeNum('tracers')
+
+    # make sure fields is not a single element
+    if isinstance(parentFields, six.string_types):
+        parentFields = [parentFields]
+
+    index = loadIndex(basePath, snapNum)
+
+    offset = subset['offsetType'][ptTracer] if subset else 0
+    numTracers = subset['lenType'][ptTracer] if subset else index['numPart'][ptTracer]
+
+    # sorted IDs, and the global index of each, of all candidate parents (numeric types only, since a
+    # tracer of a wind phase cell has a type 4 parent as well)
+    parents = {}
+    for ptNum in sorted(set(partTypeNum(partType) for partType in parentTypes)):
+        if subset:
+            if not subset['lenType'][ptNum]:
+                continue
+            ids = loadSubset(basePath, snapNum, ptNum, fields=['ParticleIDs'], subset=subset)
+            order = np.argsort(ids, kind='stable')
+            parents[ptNum] = (ids[order], order + subset['offsetType'][ptNum])
+        elif index['numPart'][ptNum]:
+            idIndex = loadIDIndex(basePath, snapNum, ptNum)
+            parents[ptNum] = (idIndex['ParticleIDs'], idIndex['Index'])
+
+    result = {'count'       : numTracers,
+              'ParentType'  : np.full(numTracers, -1, dtype=np.int8),
+              'ParentIndex' : np.full(numTracers, -1, dtype=np.int64)}
+
+    if not numTracers:
+        return result
+
+    # stream the tracers, matching each block against every parent type
+    for block in iterSubset(basePath, snapNum, ptTracer, ['ParentID'], subset=subset, blockSize=blockSize,
+                            nThreads=nThreads):
+        start = block['offset'] - offset
+        parentType = result['ParentType'][start:start+block['count']]
+        parentIndex = result['ParentIndex'][start:start+block['count']]
+
+        for ptNum, (sortedIDs, rows) in parents.items():
+            found, pos = _matchIDs(sortedIDs, block['ParentID'])
+            parentType[found] = ptNum
+            parentIndex[found] = rows[pos]
+
+    if not parentFields:
+        return result
+
+    # load the requested fields of the parents, type by type, reading each parent once
+    for ptNum in parents:
+        w = np.where(result['ParentType'] == ptNum)[0]
+        fields = [field for field in parentFields if field in index['fields'][ptNum]]
+        if not w.size or not fields:
+            continue
+
+        uniqueRows, inverse = np.unique(result['ParentIndex'][w], return_inverse=True)
+        fieldMdi = [mdi[parentFields.index(field)] for field in fields] if mdi is not None else None
+        data = _loadRows(basePath, snapNum, ptNum, fields, uniqueRows, fieldMdi, float32, nThreads=nThreads)
+
+        for field in fields:
+            if field not in result:
+                result[field] = np.zeros((numTracers,) + data[field].shape[1:], dtype=data[field].dtype)
+            result[field][w] = data[field][inverse]
+
+    return result
+
+
+def getSnapOffsets(basePath, snapNum, id, type):
+    """ Compute offsets within snapshot for a particular group/subgroup. """
+    r = {}
+    offsets = loadOffsets(basePath, snapNum) # shared, loaded once per snapshot
+
+    # copies of the shared (read-only) tables, which callers may modify
+    r['snapOffsets'] = np.array(offsets.snapOffsets())
+
+    # load the length (by type) of this group/subgroup from the group catalog
+    r['lenType'] = offsets.lenType(type, [id])[0]
+
+    # the offset (by type) of this group/subgroup within the snapshot
+    r['offsetType'] = np.array(offsets.table(type, 'SnapByType')[id, :])
+
+    # add TNG-Cluster specific offsets if present
+    r.update({key: np.array(value) for key, value in offsets.originalZooms().items()})
+
+    return r
+
+
+def getSnapOffsetsMulti(basePath, snapNum, ids, type):
+    """ Compute offsets within snapshot for many groups/subgroups at once (vectorized getSnapOffsets).
+        Return a dict with lenType and offsetType, each of shape [len(ids), nTypes], aligned with ids. """
+    ids = np.asarray(ids, dtype=np.int64).ravel()
+    offsets = loadOffsets(basePath, snapNum)
+
+    lenType = offsets.lenType(type, ids)
+    offsetType = np.asarray(offsets.table(type, 'SnapByType')[ids], dtype=np.int64)
+
+    return {'lenType': lenType, 'offsetType': offsetType}
+
+
+def loadSubhalo(basePath, snapNum, id, partType, fields=None, where=None, physical=False, params=None):
+    """ Load all particles/cells of one type for a specific subhalo
+        (optionally restricted to a subset fields, and to those satisfying where, see loadSubset). """
+    # load subhalo length, compute offset, call loadSubset
+    subset = getSnapOffsets(basePath, snapNum, id, "Subhalo")
+    return loadSubset(basePath, snapNum, partType, fields, subset=subset, where=where, physical=physical,
+                      params=params)
+
+
+def loadHalo(basePath, snapNum, id, partType, fields=None, where=None, physical=False, params=None):
+    """ Load all particles/cells of one type for a specific halo
+        (optionally restricted to a subset fields, and to those satisfying where, see loadSubset). """
+    # load halo length, compute offset, call loadSubset
+    subset = getSnapOffsets(basePath, snapNum, id, "Group")
+    return loadSubset(basePath, snapNum, partType, fields, subset=subset, where=where, physical=physical,
+                      params=params)
+
+
+def _loadMulti(basePath, snapNum, ids, type, partType, fields, iterate, nThreads, where):
+    """ Load all particles/cells of one type for many groups/subgroups, merging their particle ranges
+        and reading each file chunk once. See loadHalos() and loadSubhalos(). """
+    ptNum = partTypeNum(partType)
+    gName = "PartType" + str(ptNum)
+
+    # make sure fields is not a single element
+    if isinstance(fields, six.string_types):
+        fields = [fields]
+
+    index = loadIndex(basePath, snapNum)
+    where = _typeWhere(index, partType, where)
+
+    # resolve offsets and lengths of all objects in one pass
+    subset = getSnapOffsetsMulti(basePath, snapNum, ids, type)
+    starts = subset['offsetType'][:, ptNum]
+    lengths = subset['lenType'][:, ptNum]
+
+    # merge overlapping or adjacent particle ranges, in snapshot order
+    w = np.where(lengths > 0)[0]
+    w = w[np.argsort(starts[w], kind='stable')]
+
+    ends = np.maximum.accumulate(starts[w] + lengths[w])
+    newRange = np.ones(w.size, dtype=bool)
+    newRange[1:] = starts[w][1:] > ends[:-1]
+    lastOfRange = np.append(newRange[1:], True)[:w.size]
+
+    rangeNum = np.cumsum(newRange) - 1
+    rangeStarts = starts[w][newRange]
+    rangeLengths = ends[lastOfRange] - rangeStarts
+
+    if where is None:
+        # position of each range, and of each object, within the buffer of all merged ranges
+        rangeBufOffsets = np.cumsum(rangeLengths) - rangeLengths
+        bufOffsets = np.zeros(lengths.size, dtype=np.int64)
+        bufOffsets[w] = rangeBufOffsets[rangeNum] + (starts[w] - rangeStarts[rangeNum])
+    else:
+        # select the matching rows of all merged ranges, then express each object by its matches
+        rows = [np.zeros(0, dtype=np.int64)]
+
+        for data, dataRows in _iterRanges(basePath, snapNum, ptNum, whereFields(where), rangeStarts,
+                                          rangeLengths, nThreads=nThreads):
+            rows.append(dataRows[whereMask(where, data)])
+
+        rows = np.concatenate(rows)
+        bufOffsets = np.searchsorted(rows, starts)
+        lengths = np.searchsorted(rows, starts + lengths) - bufOffsets
+        w = np.where(lengths > 0)[0]
+
+    # CSR layout of the output, in the order of the input ids
+    offsets = np.cumsum(lengths) - lengths
+    result = {'count': np.int64(lengths.sum()), 'offsets': offsets, 'lengths': lengths}
+
+    if result['count']:
+        if where is None:
+            # read all ranges, opening each file chunk only once
+            numToRead = int(rangeLengths.sum())
+            fields = _allocate(index, ptNum, fields, None, False, numToRead, result, shared=numProcs(nThreads) > 1)
+
+            pieces = []
+            for rangeStart, rangeLength, rangeBufOffset in zip(rangeStarts, rangeLengths, rangeBufOffsets):
+                pieces += [(fileNum, fileOff, num, rangeBufOffset + wOffset) for fileNum, fileOff, num, wOffset
+                           in _chunkSlices(index, ptNum, rangeStart, rangeLength)]
+
+            numRead = _readPieces(basePath, snapNum, gName, fields, None, result, pieces, nThreads)
+
+            if numToRead != numRead:
+                raise Exception("Read ["+str(numRead)+"] particles, but was expecting ["+str(numToRead)+"]")
+        else:
+            # read the matching rows only
+            numToRead = rows.size
+            fields = fields if fields else list(index['fields'][ptNum].keys())
+            _loadRows(basePath, snapNum, ptNum, fields, rows, nThreads=nThreads, result=result)
+            result['count'] = np.int64(lengths.sum())
+
+        # re-arrange into the order of the input ids, unless the buffer is already in that order
+        if numToRead != result['count'] or np.any(bufOffsets[w] != offsets[w]):
+            gather = np.repeat(bufOffsets - offsets, lengths) + np.arange(result['count'])
+            for field in fields:
+                result[field] = result[field][gather]
+
+    if not iterate:
+        return result
+
+    return _iterMulti(result, fields)
+
+
+def _iterMulti(result, fields):
+    """ Generator over the per-object results (as returned by loadHalo/loadSubhalo) of a CSR result. """
+    for offset, length in zip(result['offsets'], result['lengths']):
+        r = {'count': length}
+
+        if length:
+            for field in fields:
+                r[field] = result[field][offset:offset+length]
+
+            # only a single field? then return the array instead of a single item dict
+            if len(fields) == 1:
+                r = r[fields[0]]
+
+        yield r
+
+
+def loadSubhalos(basePath, snapNum, ids, partType, fields=None, iterate=False, nThreads=1, where=None):
+    """ Load all particles/cells of one type for many subhalos at once (optionally restricted to a subset
+        fields). Overlapping and adjacent particle ranges are merged, and each file chunk is read once.
+        Return a dict with the concatenated fields of all subhalos, in the order of ids, together with
+        offsets and lengths giving the range of each subhalo. If iterate is True, instead return an
+        iterator over the individual results of each subhalo, as loadSubhalo() would return them.
+        If where is specified, load only particles/cells satisfying it (see loadSubset). """
+    return _loadMulti(basePath, snapNum, ids, "Subhalo", partType, fields, iterate, nThreads, where)
+
+
+def loadHalos(basePath, snapNum, ids, partType, fields=None, iterate=False, nThreads=1, where=None):
+    """ Load all particles/cells of one type for many halos at once (optionally restricted to a subset
+        fields). Overlapping and adjacent particle ranges are merged, and each file chunk is read once.
+        Return a dict with the concatenated fields of all halos, in the order of ids, together with
+        offsets and lengths giving the range of each halo. If iterate is True, instead return an
+        iterator over the individual results of each halo, as loadHalo() would return them.
+        If where is specified, load only particles/cells satisfying it (see loadSubset). """
+    return _loadMulti(basePath, snapNum, ids, "Group", partType, fields, iterate, nThreads, where)
+
+
+reduceOps = ['sum', 'count', 'mean', 'wmean', 'min', 'max', 'hist']
+
+def reduceByGroup(basePath, snapNum, partType, field, op='sum', groupType='Group', weights=None, bins=None,
+                  blockSize=4194304, nThreads=1, where=None, physical=False, params=None):
+    """ Reduce a field over the particles/cells of a given partType of every halo (groupType='Group') or
+        subhalo (groupType='Subhalo'), without loading them: the snapshot is streamed once, in file
+        order, in blocks of blockSize, and each particle is assigned to its object using the LenType and
+        offsets of the group catalog. op is one of
+          'sum', 'count' (number of particles), 'mean', 'min', 'max',
+          'wmean' (mean weighted by the field weights, e.g. field='GFM_Metallicity' and
+            weights='StarFormationRate'), or
+          'hist' (histogram of field with the given bin edges, summing weights if given).
+        Return an array with one entry per object (for 'hist', one row of len(bins)-1 bins), in which
+        objects without particles are zero for 'sum', 'count' and 'hist', and NaN otherwise. Arguments
+        where, physical and params are as for loadSubset(); field may be a derived field. """
+    if op not in reduceOps:
+        raise Exception("Unknown reduction op ["+str(op)+"], should be one of "+str(reduceOps))
+    if op == 'wmean' and weights is None:
+        raise Exception("Reduction op [wmean] requires weights")
+    if op == 'hist' and bins is None:
+        raise Exception("Reduction op [hist] requires bins")
+
+    ptNum = partTypeNum(partType)
+    params = dict(params or {}, physical=physical)
+
+    index = loadIndex(basePath, snapNum)
+    where = _typeWhere(index, partType, where)
+
+    # particle range of every object, ordered by offset
+    header = loadHeader(basePath, snapNum)
+    nName = 'Ngroups_Total' if groupType == 'Group' else 'Nsubgroups_Total'
+    if nName not in header:
+        nName = 'Nsubhalos_Total' # alternate convention
+    numObjects = int(header[nName])
+
+    offsets = getSnapOffsetsMulti(basePath, snapNum, np.arange(numObjects), groupType)
+    order = np.lexsort((offsets['lenType'][:, ptNum], offsets['offsetType'][:, ptNum])) # empty ones first
+    starts = offsets['offsetType'][order, ptNum]
+    ends = starts + offsets['lenType'][order, ptNum]
+
+    fields = [field] + ([weights] if weights is not None else [])
+    fields += [whereField for whereField in whereFields(where or []) if whereField not in fields]
+
+    # accumulators (in float64, or int64 for integer sums), with the shape of one value of field
+    probe = {}
+    _allocate(index, ptNum, [field], None, False, 0, probe)
+    shape, dtype = probe[field].shape[1:], probe[field].dtype
+
+    count = np.zeros(numObjects, dtype=np.int64)
+    if op == 'hist':
+        bins = np.asarray(bins)
+        total = np.zeros((numObjects, bins.size - 1), dtype=np.float64)
+    elif op in ['min', 'max']:
+        total = np.full((numObjects,) + shape, np.inf if op == 'min' else -np.inf)
+    else:
+        total = np.zeros((numObjects,) + shape, dtype=np.int64 if dtype.kind in 'iub' else np.float64)
+    weightTotal = np.zeros(numObjects, dtype=np.float64)
+
+    numToRead = int(ends.max()) if numObjects else 0
+
+    for data, rows in _iterRanges(basePath, snapNum, ptNum, fields, [0], [numToRead], blockSize=blockSize,
+                                  nThreads=nThreads, params=params):
+        # assign each particle to the object whose range contains it (none, for the fuzz)
+        labels = np.searchsorted(starts, rows, side='right') - 1
+        mask = (labels >= 0) & (rows < ends[np.maximum(labels, 0)])
+        if where is not None:
+            mask &= whereMask(where, data)
+
+        w = np.where(mask)[0]
+        if not w.size:
+            continue
+
+        labels = labels[w]
+        values = data[field][w]
+        weight = data[weights][w].astype(np.float64) if weights is not None else None
+
+        if op == 'hist':
+            binNums = np.searchsorted(bins, values, side='right') - 1
+            binNums[values == bins[-1]] = bins.size - 2 # last bin is closed, as for np.histogram
+            inRange = (binNums >= 0) & (binNums < bins.size - 1)
+            total += np.bincount(labels[inRange] * (bins.size - 1) + binNums[inRange],
+                                 weights=weight[inRange] if weight is not None else None,
+                                 minlength=total.size).reshape(total.shape)
+            continue
+
+        # labels are sorted (particles and objects share their order), so each object is a single run
+        runs = np.where(np.diff(labels, prepend=-1) != 0)[0]
+        objects = labels[runs]
+        count[objects] += np.diff(np.append(runs, labels.size))
+
+        if op in ['sum', 'mean']:
+            total[objects] += np.add.reduceat(values.astype(total.dtype), runs, axis=0)
+        elif op == 'wmean':
+            weight = weight.reshape((-1,) + (1,) * len(shape))
+            total[objects] += np.add.reduceat(values * weight, runs, axis=0)
+            weightTotal[objects] += np.add.reduceat(weight.ravel(), runs)
+        elif op == 'min':
+            total[objects] = np.minimum(total[objects], np.minimum.reduceat(values, runs, axis=0))
+        elif op == 'max':
+            total[objects] = np.maximum(total[objects], np.maximum.reduceat(values, runs, axis=0))
+
+    # normalize, and mark objects without particles
+    empty = (count == 0).reshape((-1,) + (1,) * len(shape))
+
+    if op == 'count':
+        total = count
+    elif op == 'mean':
+        total = np.where(empty, np.nan, total / np.maximum(count, 1).reshape(empty.shape))
+    elif op == 'wmean':
+        with np.errstate(invalid='ignore', divide='ignore'):
+            total = np.where(empty, np.nan, total / weightTotal.reshape(empty.shape))
+    elif op in ['min', 'max']:
+        total = np.where(empty, np.nan, total)
+
+    # back into the order of the group catalog
+    result = np.zeros_like(total)
+    result[order] = total
+
+    return result
+
+
+def _buildMembership(f, basePath, snapNum, ptNum, blockSize):
+    """ Write the index of the parent object of every particle of one type, for halos and subhalos, from
+        the LenType and offsets of the group catalog, into the datasets 'GroupIndex' and 'SubhaloIndex' of
+        the open HDF5 file f, which are filled with -1. Each batch of objects (covering at most about
+        blockSize particles) is filled with one vectorized scatter into the rows it spans, which are then
+        written, so that the arrays are never held in memory as a whole. """
+    header = loadHeader(basePath, snapNum)
+    numPart = int(loadIndex(basePath, snapNum)['numPart'][ptNum])
+
+    for key, groupType, nName in [('GroupIndex', 'Group', 'Ngroups_Total'),
+                                  ('SubhaloIndex', 'Subhalo', 'Nsubgroups_Total')]:
+        if nName not in header:
+            nName = 'Nsubhalos_Total' # alternate convention
+        numObjects = int(header[nName])
+
+        dtype = np.int32 if numObjects < np.iinfo(np.int32).max else np.int64
+
+        # stored contiguous and uncompressed, such that it can be memory-mapped
+        membership = f.create_dataset(key, shape=(numPart,), dtype=dtype, fillvalue=-1)
+        if not numObjects:
+            if numPart:
+                membership[:1] = -1 # allocate (and fill) the dataset on disk
+            continue
+
+        offsets = getSnapOffsetsMulti(basePath, snapNum, np.arange(numObjects), groupType)
+        starts = offsets['offsetType'][:, ptNum]
+        lengths = offsets['lenType'][:, ptNum]
+
+        # batches of consecutive objects, split wherever their cumulative length crosses a multiple of blockSize
+        bufOffsets = np.cumsum(lengths) - lengths
+        batchEdges = np.append(np.where(np.diff(bufOffsets // blockSize, prepend=-1) != 0)[0], numObjects)
+
+        for i0, i1 in zip(batchEdges[:-1], batchEdges[1:]):
+            lens = lengths[i0:i1]
+            if not lens.sum():
+                continue
+
+            # consecutive objects cover consecutive rows, apart from particles of no object between them
+            first = starts[i0:i1][lens > 0].min()
+            last = (starts[i0:i1] + lens)[lens > 0].max()
+            rows = np.repeat(starts[i0:i1] - (np.cumsum(lens) - lens), lens) + np.arange(lens.sum())
+
+            batch = np.full(last - first, -1, dtype=dtype)
+            batch[rows - first] = np.repeat(np.arange(i0, i1, dtype=dtype), lens)
+            membership[first:last] = batch
+
+
+def loadMembership(basePath, snapNum, partType, blockSize=4194304, cache=True):
+    """ Return, for every particle/cell of a given partType, the index of the halo ('GroupIndex') and of
+        the subhalo ('SubhaloIndex') it belongs to, or -1 if none (fuzz). Built once from the group
+        catalog, then kept in a sidecar file whose arrays are memory-mapped. Both are also available to
+        loadSubset() and the other loaders as the pseudo-fields 'GroupIndex' and 'SubhaloIndex'.
+        If cache is False, always rebuild the arrays. """
+    ptNum = partTypeNum(partType)
+    key = ('membership', snapNum, ptNum)
+    sim = simulation(basePath)
+
+    if cache and key in sim.values:
+        return sim.values[key]
+
+    membership = cachedArrays(basePath, 'membership_%03d_%d.hdf5' % (snapNum, ptNum),
+                              lambda: _sourceStamp(basePath, snapNum),
+                              lambda f: _buildMembership(f, basePath, snapNum, ptNum, blockSize), cache)
+
+    sim.values[key] = membership
+
+    return membership
+
+
+def _membershipField(name):
+    """ Derived field func returning one of the membership arrays (see loadMembership). """
+    def func(data, ctx):
+        membership = loadMembership(ctx['basePath'], ctx['snapNum'], ctx['ptNum'])[name]
+        return membership[ctx['offset']:ctx['offset']+ctx['count']]
+    return func
+
+registerField('GroupIndex', [], _membershipField('GroupIndex'), dtype=np.int64)
+registerField('SubhaloIndex', [], _membershipField('SubhaloIndex'), dtype=np.int64)
+
+
+def loadOriginalZoom(basePath, snapNum, id, partType, fields=None):
+    """ Load all particles/cells of one type corresponding to an
+        original (entire) zoom simulation. TNG-Cluster specific.
+        (optionally restricted to a subset fields). """
+    # load fuzz length, compute offset, call loadSubset                                                                     
+    subset = getSnapOffsets(basePath, snapNum, id, "Group")
+
+    # identify original halo ID and corresponding index
+    halo = loadSingle(basePath, snapNum, haloID=id)
+    assert 'GroupOrigHaloID' in halo, 'Error: loadOriginalZoom() only for the TNG-Cluster simulation.'
+    orig_index = np.where(subset['HaloIDs'] == halo['GroupOrigHaloID'])[0][0]
+
+    # (1) load all FoF particles/cells
+    subset['lenType'] = subset['GroupsTotalLengthByType'][orig_index, :]
+    subset['offsetType'] = subset['GroupsSnapOffsetByType'][orig_index, :]
+
+    data1 = loadSubset(basePath, snapNum, partType, fields, subset=subset)
+
+    # (2) load all non-FoF particles/cells
+    subset['lenType'] = subset['OuterFuzzTotalLengthByType'][orig_index, :]
+    subset['offsetType'] = subset['OuterFuzzSnapOffsetByType'][orig_index, :]
+
+    data2 = loadSubset(basePath, snapNum, partType, fields, subset=subset)
+
+    # combine and return
+    if isinstance(data1, np.ndarray):
+        # protect against empty data
+        if isinstance(data2, dict):
+            return data1
+        return np.concatenate((data1,data2), axis=0)
+    
+    # protect against empty data
+    if data1["count"] == 0:
+        return data2
+    elif data2["count"] == 0:
+        return data1
+    
+    data = {'count':data1['count']+data2['count']}
+    for key in data1.keys():
+        if key == 'count': continue
+        data[key] = np.concatenate((data1[key],data2[key]), axis=0)
+    return data
+
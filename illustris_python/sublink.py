@@ -2,13 +2,12 @@
 sublink.py: File I/O related to the Sublink merger tree files. """
 
 import numpy as np
-import h5py
-import glob
 import six
 import os
+from functools import partial
 
-from .groupcat import gcPath, offsetPath
-from .util import partTypeNum
+from .groupcat import loadOffsets, loadHeader
+from .util import partTypeNum, openFile, simulation, parallelMap, readRows, cachedArrays
 
 
 def treePath(basePath, treeName, chunkNum=0):
@@ -16,18 +15,15 @@ def treePath(basePath, treeName, chunkNum=0):
     # tree_path = '/trees/' + treeName + '/' + 'tree_extended.' + str(chunkNum) + '.hdf5'
     tree_path = os.path.join('trees', treeName, 'tree_extended.' + str(chunkNum) + '.hdf5')
 
-    _path = os.path.join(basePath, tree_path)
-    if len(glob.glob(_path)):
-        return _path
-
-    # new path scheme
-    _path = os.path.join(basePath, os.path.pardir, 'postprocessing', tree_path)
-    if len(glob.glob(_path)):
-        return _path
+    _paths = [os.path.join(basePath, tree_path),
+              # new path scheme
+              os.path.join(basePath, os.path.pardir, 'postprocessing', tree_path),
+              # try one or more alternative path schemes before failing
+              os.path.join(basePath, 'postprocessing', tree_path)]
 
-    # try one or more alternative path schemes before failing
-    _path = os.path.join(basePath, 'postprocessing', tree_path)
-    if len(glob.glob(_path)):
+    # the path scheme is detected once per tree, see util.Simulation
+    _path = simulation(basePath).resolve(('sublink', treeName), _paths)
+    if _path is not None:
         return _path
 
     raise ValueError("Could not construct treePath from basePath = '{}'".format(basePath))
@@ -35,42 +31,44 @@ def treePath(basePath, treeName, chunkNum=0):
 
 def treeOffsets(basePath, snapNum, id, treeName):
     """ Handle offset loading for a SubLink merger tree cutout. """
-    # old or new format
-    if 'fof_subhalo' in gcPath(basePath, snapNum) or treeName == "SubLink_gal":
-        # load groupcat chunk offsets from separate 'offsets_nnn.hdf5' files
-        with h5py.File(offsetPath(basePath, snapNum), 'r') as f:
-            groupFileOffsets = f['FileOffsets/Subhalo'][()]
-
-        offsetFile = offsetPath(basePath, snapNum)
-        prefix = 'Subhalo/' + treeName + '/'
-
-        groupOffset = id
-    else:
-        # load groupcat chunk offsets from header of first file
-        with h5py.File(gcPath(basePath, snapNum), 'r') as f:
-            groupFileOffsets = f['Header'].attrs['FileOffsets_Subhalo']
-
-        # calculate target groups file chunk which contains this id
-        groupFileOffsets = int(id) - groupFileOffsets
-        fileNum = np.max(np.where(groupFileOffsets >= 0))
-        groupOffset = groupFileOffsets[fileNum]
-
-        offsetFile = gcPath(basePath, snapNum, fileNum)
-        prefix = 'Offsets/Subhalo_Sublink'
-
-    with h5py.File(offsetFile, 'r') as f:
-        # load the merger tree offsets of this subgroup
-        RowNum     = f[prefix+'RowNum'][groupOffset]
-        LastProgID = f[prefix+'LastProgenitorID'][groupOffset]
-        SubhaloID  = f[prefix+'SubhaloID'][groupOffset]
-        return RowNum, LastProgID, SubhaloID
-
-offsetCache = dict()
-
-def subLinkOffsets(basePath, treeName, cache=True):
-    # create quick offset table for rows in the SubLink files
+    # tables from the offsets file (new format, or SubLink_gal) or group catalog (old format), loaded once
+    offsets = loadOffsets(basePath, snapNum)
+
+    # load the merger tree offsets of this subgroup
+    RowNum     = offsets.table('Subhalo', treeName+'/RowNum')[id]
+    LastProgID = offsets.table('Subhalo', treeName+'/LastProgenitorID')[id]
+    SubhaloID  = offsets.table('Subhalo', treeName+'/SubhaloID')[id]
+    return RowNum, LastProgID, SubhaloID
+
+def _treeStamp(basePath, treeName):
+    """ Return the size and modification time of each tree file, to validate caches derived from them. """
+    search_path = treePath(basePath, treeName, '*')
+    numTreeFiles = simulation(basePath).count(('sublinkFiles', treeName), search_path)
+    stamp = np.zeros((numTreeFiles, 2), dtype=np.int64)
+
+    for i in range(numTreeFiles):
+        st = os.stat(treePath(basePath, treeName, i))
+        stamp[i] = [st.st_size, st.st_mtime_ns]
+
+    return stamp
+
+
+def _treeFileRows(basePath, treeName, fileNum):
+    """ Return the number of rows of one tree file (from its metadata only). """
+    with openFile(treePath(basePath, treeName, fileNum)) as f:
+        return f['SubhaloID'].shape[0]
+
+
+def subLinkOffsets(basePath, treeName, cache=True, nThreads=None):
+    """ Return the first row of each SubLink tree file, in the rows of all files concatenated. The
+        table is kept in memory (in cache, if a dict, or per simulation, see util.Simulation) and in a
+        small index file (see util.cachePath) together with the number of rows of each file, which is
+        validated against the sizes and modification times of the tree files, such that new processes
+        need not scan them. If the index has to be (re)built and nThreads > 1 (by default, OMP_NUM_THREADS,
+        then with worker processes for this call only), scan that many tree files concurrently in worker
+        processes (see util.parallelMap). If cache is False, always scan all tree files. """
     if cache is True:
-        cache = offsetCache
+        cache = simulation(basePath).memo('subLinkOffsets', dict)
 
     if type(cache) is dict:
         path = os.path.join(basePath, treeName)
@@ -80,14 +78,18 @@ def subLinkOffsets(basePath, treeName, cache=True):
             pass
 
     search_path = treePath(basePath, treeName, '*')
-    numTreeFiles = len(glob.glob(search_path))
+    stamp = _treeStamp(basePath, treeName)
+    numTreeFiles = stamp.shape[0]
     if numTreeFiles == 0:
         raise ValueError("No tree files found! for path '{}'".format(search_path))
-    offsets = np.zeros(numTreeFiles, dtype='int64')
 
-    for i in range(numTreeFiles-1):
-        with h5py.File(treePath(basePath, treeName, i), 'r') as f:
-            offsets[i+1] = offsets[i] + f['SubhaloID'].shape[0]
+    def build(f):
+        func = partial(_treeFileRows, basePath, treeName)
+        numRows = np.array(list(parallelMap(func, nThreads, range(numTreeFiles))), dtype=np.int64)
+        return {'offsets': np.cumsum(numRows) - numRows, 'numRows': numRows}
+
+    offsets = cachedArrays(basePath, 'sublink_offsets_%s.hdf5' % treeName, lambda: stamp, build,
+                           cache is not False)['offsets']
 
     if type(cache) is dict:
         cache[path] = offsets
@@ -127,7 +129,7 @@ def loadTree(basePath, snapNum, id, fields=None, onlyMPB=False, onlyMDB=False, t
 
     # load only main progenitor branch? in this case, get MainLeafProgenitorID now
     if onlyMPB:
-        with h5py.File(treePath(basePath, treeName, fileNum), 'r') as f:
+        with openFile(treePath(basePath, treeName, fileNum)) as f:
             MainLeafProgenitorID = f['MainLeafProgenitorID'][fileOff]
 
         # re-calculate rowEnd
@@ -135,7 +137,7 @@ def loadTree(basePath, snapNum, id, fields=None, onlyMPB=False, onlyMDB=False, t
 
     # load only main descendant branch (e.g. from z=0 descendant to current subhalo)
     if onlyMDB:
-        with h5py.File(treePath(basePath, treeName, fileNum),'r') as f:
+        with openFile(treePath(basePath, treeName, fileNum)) as f:
             RootDescendantID = f['RootDescendantID'][fileOff]
 
         # re-calculate tree subset (rowStart), either single branch to root descendant, or 
@@ -151,7 +153,7 @@ def loadTree(basePath, snapNum, id, fields=None, onlyMPB=False, onlyMDB=False, t
     # read
     result = {'count': nRows}
 
-    with h5py.File(treePath(basePath, treeName, fileNum), 'r') as f:
+    with openFile(treePath(basePath, treeName, fileNum)) as f:
         # if no fields requested, return all fields
         if not fields:
             fields = list(f.keys())
@@ -174,6 +176,321 @@ def loadTree(basePath, snapNum, id, fields=None, onlyMPB=False, onlyMDB=False, t
     return result
 
 
+def _readTreeFile(basePath, treeName, fields, fileNum, starts, lengths):
+    """ Read the row ranges [starts, starts+lengths) of one tree file, and return them concatenated.
+        Nearby and overlapping ranges share their reads. """
+    rows = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+    uniqueRows, inverse = np.unique(rows, return_inverse=True)
+
+    with openFile(treePath(basePath, treeName, fileNum)) as f:
+        if uniqueRows.size and uniqueRows[-1] >= f['SubfindID'].shape[0]:
+            raise Exception('Should not occur. Each tree is contained within a single file.')
+
+        return {field: readRows(f[field], uniqueRows)[inverse] for field in fields}
+
+
+def _readTrees(basePath, treeName, fields, result, fileNums, starts, lengths, offsets, nThreads=1):
+    """ Read row ranges, given per tree file by fileNums, into the preallocated result at
+        [offsets, offsets+lengths), with one task (and a few reads) per file. If nThreads > 1, the
+        tasks run in that many worker processes (see util.parallelMap). """
+    w = np.where(lengths > 0)[0]
+    w = w[np.argsort(fileNums[w], kind='stable')]
+    files, first = np.unique(fileNums[w], return_index=True)
+    groups = np.split(w, first[1:]) if w.size else []
+
+    func = partial(_readTreeFile, basePath, treeName, fields)
+    data = parallelMap(func, nThreads, files, [starts[k] for k in groups], [lengths[k] for k in groups])
+
+    for k, fileData in zip(groups, data):
+        positions = np.repeat(offsets[k] - (np.cumsum(lengths[k]) - lengths[k]), lengths[k]) + \
+                    np.arange(lengths[k].sum())
+        for field in fields:
+            result[field][positions] = fileData[field]
+
+
+def loadTrees(basePath, snapNum, ids, fields=None, onlyMPB=False, onlyMDB=False, treeName="SubLink",
+              cache=True, nThreads=1):
+    """ Load the Sublink trees (or only their main progenitor or descendant branches, as in loadTree)
+        of many subhalos at once (optionally restricted to a subset fields). The row ranges of all
+        trees are resolved together, and grouped per tree file, which is then read in a few large reads.
+        Return a dict with the trees concatenated in the order of ids, and the 'offsets' and 'lengths'
+        of the tree of each subhalo (of length zero, if it is not in the tree). If nThreads > 1, read
+        that many tree files concurrently in worker processes (see util.parallelMap). """
+    ids = np.asarray(ids, dtype=np.int64).ravel()
+
+    # make sure fields is not a single element
+    if isinstance(fields, six.string_types):
+        fields = [fields]
+
+    # offsets of all trees, at once
+    offsets = loadOffsets(basePath, snapNum)
+
+    RowNum     = np.asarray(offsets.table('Subhalo', treeName+'/RowNum')[ids], dtype=np.int64)
+    LastProgID = np.asarray(offsets.table('Subhalo', treeName+'/LastProgenitorID')[ids], dtype=np.int64)
+    SubhaloID  = np.asarray(offsets.table('Subhalo', treeName+'/SubhaloID')[ids], dtype=np.int64)
+
+    found = RowNum != -1
+
+    # find the tree file chunk containing each tree, and its row there
+    fileOffsets = subLinkOffsets(basePath, treeName, cache)
+    fileNums = np.searchsorted(fileOffsets, RowNum, side='right') - 1
+    fileNums[~found] = 0
+    starts = RowNum - fileOffsets[fileNums]
+
+    lengths = LastProgID - SubhaloID + 1
+
+    # only a single branch? then get MainLeafProgenitorID or RootDescendantID of all subhalos now
+    if onlyMPB or onlyMDB:
+        branchField = 'RootDescendantID' if onlyMDB else 'MainLeafProgenitorID'
+        branch = {branchField: np.zeros(ids.size, dtype=np.int64)}
+        _readTrees(basePath, treeName, [branchField], branch, fileNums, starts, found.astype(np.int64),
+                   np.arange(ids.size), nThreads)
+        branchID = branch[branchField]
+
+        if onlyMDB:
+            # single branch to root descendant, ending at this subhalo
+            lengths = SubhaloID - branchID + 1
+            starts = starts - (lengths - 1)
+        else:
+            lengths = branchID - SubhaloID + 1
+
+    lengths[~found] = 0
+    result = {'count': lengths.sum(), 'offsets': np.cumsum(lengths) - lengths, 'lengths': lengths}
+
+    with openFile(treePath(basePath, treeName, fileNums[found][0] if found.any() else 0)) as f:
+        # if no fields requested, return all fields
+        if not fields:
+            fields = list(f.keys())
+
+        for field in fields:
+            if field not in f.keys():
+                raise Exception("SubLink tree does not have field ["+field+"]")
+
+            result[field] = np.zeros((result['count'],) + f[field].shape[1:], dtype=f[field].dtype)
+
+    _readTrees(basePath, treeName, fields, result, fileNums, starts, lengths, result['offsets'], nThreads)
+
+    return result
+
+
+class Forest(object):
+    """ In-memory index of all SubLink trees (of one treeName): for each row of the tree files,
+        concatenated in order (see subLinkOffsets), its SnapNum and the row of its first progenitor
+        and of its descendant (-1 if none). Main branches of many subhalos are then followed all at
+        once, one snapshot per step, without reading the tree files again. Use loadForest() to build it
+        (once). """
+
+    def __init__(self, basePath, treeName, fileOffsets, SnapNum, FirstProgenitorRow, DescendantRow):
+        self.basePath = basePath
+        self.treeName = treeName
+        self.fileOffsets = fileOffsets
+        self.SnapNum = SnapNum
+        self.FirstProgenitorRow = FirstProgenitorRow
+        self.DescendantRow = DescendantRow
+        self.numSnaps = int(SnapNum.max()) + 1 if SnapNum.size else 0
+
+    def rows(self, snapNum, ids):
+        """ Return the row of each of the given subhalos of snapNum (-1 if not in the tree). """
+        offsets = loadOffsets(self.basePath, snapNum)
+        return np.asarray(offsets.table('Subhalo', self.treeName+'/RowNum')[ids], dtype=np.int64)
+
+    def _branches(self, rows, pointers):
+        """ Follow pointers from each of the given rows, into a matrix of rows (nRows, numSnaps). """
+        rows = np.asarray(rows, dtype=np.int64).ravel()
+        result = np.full((rows.size, self.numSnaps), -1, dtype=np.int64)
+
+        index = np.where(rows >= 0)[0]
+        current = rows[index]
+
+        while index.size:
+            result[index, self.SnapNum[current]] = current
+
+            current = pointers[current].astype(np.int64)
+            w = np.where(current >= 0)[0]
+            index, current = index[w], current[w]
+
+        return result
+
+    def mpb(self, rows):
+        """ Return the rows of the main progenitor branch of each of the given rows, in a matrix of
+            shape (nRows, numSnaps) indexed by SnapNum, which is -1 for snapshots without one. """
+        return self._branches(rows, self.FirstProgenitorRow)
+
+    def mdb(self, rows):
+        """ Return the rows of the main descendant branch of each of the given rows, as in mpb(). """
+        return self._branches(rows, self.DescendantRow)
+
+    def values(self, rows, field, fill=None):
+        """ Return the values of a field of the tree files at the given rows (of any shape, e.g. as
+            from mpb()), and fill (by default -1 or nan, depending on its type) where rows is -1. """
+        rows = np.asarray(rows, dtype=np.int64)
+        valid = np.where(rows.ravel() >= 0)[0]
+        uniqueRows, inverse = np.unique(rows.ravel()[valid], return_inverse=True)
+
+        fileNums = np.searchsorted(self.fileOffsets, uniqueRows, side='right') - 1
+        files, first = np.unique(fileNums, return_index=True)
+        last = np.append(first[1:], uniqueRows.size)
+
+        data = None
+
+        for fileNum, i0, i1 in zip(files, first, last):
+            with openFile(treePath(self.basePath, self.treeName, fileNum)) as f:
+                if field not in f.keys():
+                    raise Exception("SubLink tree does not have field ["+field+"]")
+
+                if data is None:
+                    data = np.zeros((uniqueRows.size,) + f[field].shape[1:], dtype=f[field].dtype)
+                data[i0:i1] = readRows(f[field], uniqueRows[i0:i1] - self.fileOffsets[fileNum])
+
+        if data is None:
+            # no rows at all, only get the type of the field
+            with openFile(treePath(self.basePath, self.treeName, 0)) as f:
+                if field not in f.keys():
+                    raise Exception("SubLink tree does not have field ["+field+"]")
+                data = np.zeros((0,) + f[field].shape[1:], dtype=f[field].dtype)
+
+        if fill is None:
+            fill = np.nan if np.issubdtype(data.dtype, np.floating) else -1
+
+        result = np.full((rows.size,) + data.shape[1:], fill, dtype=data.dtype)
+        result[valid] = data[inverse]
+
+        return result.reshape(rows.shape + data.shape[1:])
+
+
+def _forestFile(basePath, treeName, fileNum):
+    """ Read the pointers of one tree file, and convert them into (file local) rows. """
+    with openFile(treePath(basePath, treeName, fileNum)) as f:
+        subhaloID = f['SubhaloID'][()].astype(np.int64)
+        snapNum = f['SnapNum'][()]
+        pointers = [f['FirstProgenitorID'][()], f['DescendantID'][()]]
+
+    rows = np.arange(subhaloID.size, dtype=np.int64)
+
+    # the rows of a tree are depth-first, in the order of their SubhaloIDs
+    for i, pointerID in enumerate(pointers):
+        pointerID = pointerID.astype(np.int64)
+        pointerRow = rows + (pointerID - subhaloID)
+
+        valid = (pointerID != -1) & (pointerRow >= 0) & (pointerRow < rows.size)
+        valid[valid] = subhaloID[pointerRow[valid]] == pointerID[valid]
+        pointers[i] = np.where(valid, pointerRow, -1)
+
+    return snapNum, pointers[0], pointers[1]
+
+
+def loadForest(basePath, treeName="SubLink", nThreads=1):
+    """ Return the Forest of all SubLink trees, built once from the SubhaloID, SnapNum,
+        FirstProgenitorID and DescendantID columns of each tree file (read whole) and then kept in
+        memory. If nThreads > 1, read that many tree files concurrently in worker processes (see
+        util.parallelMap). """
+    def build():
+        fileOffsets = subLinkOffsets(basePath, treeName)
+        func = partial(_forestFile, basePath, treeName)
+        files = list(parallelMap(func, nThreads, range(fileOffsets.size)))
+
+        numRows = sum(snapNum.size for snapNum, _, _ in files)
+        dtype = np.int32 if numRows < np.iinfo(np.int32).max else np.int64
+
+        snapNum = np.concatenate([snapNum for snapNum, _, _ in files])
+        arrays = []
+
+        for k in [1, 2]:
+            # from file local to global rows
+            arrays.append(np.concatenate([np.where(fileData[k] >= 0, fileData[k] + offset, -1).astype(dtype)
+                                          for fileData, offset in zip(files, fileOffsets)]))
+
+        return Forest(basePath, treeName, fileOffsets, snapNum, arrays[0], arrays[1])
+
+    return simulation(basePath).memo(('forest', treeName), build)
+
+
+def loadBranches(basePath, snapNum, ids, fields=None, onlyMDB=False, treeName="SubLink", nThreads=1):
+    """ Load the main progenitor branches (or, if onlyMDB, the main descendant branches) of many
+        subhalos at once from the Forest (see loadForest), as padded matrices of shape
+        (len(ids), numSnaps) indexed by SnapNum: the rows of the tree files ('rows', -1 where a branch
+        has no subhalo at that snapshot), and the values of each of the requested fields. """
+    ids = np.asarray(ids, dtype=np.int64).ravel()
+
+    # make sure fields is not a single element
+    if isinstance(fields, six.string_types):
+        fields = [fields]
+
+    forest = loadForest(basePath, treeName, nThreads)
+    rows = forest.rows(snapNum, ids)
+
+    result = {'count': ids.size}
+    result['rows'] = forest.mdb(rows) if onlyMDB else forest.mpb(rows)
+
+    for field in fields or []:
+        result[field] = forest.values(result['rows'], field)
+
+    return result
+
+
+def _crossMatchFile(basePath, snapA, snapB, treeName, fileNum):
+    """ Match the subhalos of snapA in one tree file to their main progenitor or descendant at snapB.
+        Return the SubfindIDs of the matched subhalos, and of their matches. """
+    snapNum, firstProgRow, descRow = _forestFile(basePath, treeName, fileNum)
+
+    with openFile(treePath(basePath, treeName, fileNum)) as f:
+        subfindID = f['SubfindID'][()]
+
+    rows = np.where(snapNum == snapA)[0]
+    pointers = firstProgRow if snapB < snapA else descRow
+    sign = 1 if snapB < snapA else -1
+
+    # follow the main branch of all subhalos at once, until reaching (or skipping) snapB
+    current = rows.copy()
+    active = np.where(sign * (snapNum[current] - snapB) > 0)[0]
+
+    while active.size:
+        current[active] = pointers[current[active]]
+        active = active[current[active] >= 0]
+        active = active[sign * (snapNum[current[active]] - snapB) > 0]
+
+    w = np.where(current >= 0)[0]
+    w = w[snapNum[current[w]] == snapB]
+
+    return subfindID[rows[w]], subfindID[current[w]]
+
+
+def crossMatch(basePath, snapA, snapB, treeName="SubLink", cache=True, nThreads=1):
+    """ For each subhalo of snapA, return the SubfindID of its main progenitor (if snapB < snapA) or
+        main descendant (if snapB > snapA) at snapB, or -1 if it has none there (or is not in the tree).
+        All tree files are read once, and one at a time. The result is kept in memory and in a sidecar
+        file (see util.cachedArrays), unless cache is False, in which case the cache directory is not
+        used at all. If nThreads > 1, read that many tree files concurrently in worker processes (see
+        util.parallelMap). """
+    key = ('crossMatch', treeName, snapA, snapB)
+    sim = simulation(basePath)
+
+    if cache and key in sim.values:
+        return sim.values[key]
+
+    def build(f):
+        header = loadHeader(basePath, snapA)
+        nName = 'Nsubgroups_Total' if 'Nsubgroups_Total' in header else 'Nsubhalos_Total'
+
+        result = np.full(int(header[nName]), -1, dtype=np.int32)
+
+        func = partial(_crossMatchFile, basePath, snapA, snapB, treeName)
+        numTreeFiles = sim.count(('sublinkFiles', treeName), treePath(basePath, treeName, '*'))
+
+        for subfindIDs, matches in parallelMap(func, nThreads, range(numTreeFiles)):
+            result[subfindIDs] = matches
+
+        return {'SubfindID': result}
+
+    result = cachedArrays(basePath, 'crossmatch_%s_%03d_%03d.hdf5' % (treeName, snapA, snapB),
+                          lambda: _treeStamp(basePath, treeName), build, cache)['SubfindID']
+
+    if cache:
+        sim.values[key] = result
+
+    return result
+
+
 def maxPastMass(tree, index, partType='stars'):
     """ Get maximum past mass (of the given partType) along the main branch of a subhalo
         specified by index within this tree. """
@@ -184,50 +501,168 @@ def maxPastMass(tree, index, partType='stars'):
     return np.max(masses)
 
 
-def numMergers(tree, minMassRatio=1e-10, massPartType='stars', index=0, alongFullTree=False):
-    """ Calculate the number of mergers, along the main progenitor branch, in this sub-tree 
-    (optionally above some mass ratio threshold). If alongFullTree, count across the full 
-    sub-tree and not only along the MPB. """
-    # verify the input sub-tree has the required fields
+def _treeLastRows(tree):
+    """ Return the last row of the tree containing each row, for a single tree (loadTree) or many
+        concatenated trees with 'offsets' and 'lengths' (loadTrees). """
+    numRows = len(tree['SubhaloID'])
+
+    if 'offsets' in tree and 'lengths' in tree:
+        lengths = np.asarray(tree['lengths'], dtype=np.int64)
+        return np.repeat(np.asarray(tree['offsets'], dtype=np.int64) + lengths - 1, lengths)
+
+    return np.full(numRows, numRows - 1, dtype=np.int64)
+
+
+def _mainBranchEnds(tree):
+    """ Return the row of the main leaf progenitor of each row, i.e. the main progenitor branch of row
+        i is the consecutive rows i, ..., ends[i] (clipped to its tree). """
+    rows = np.arange(len(tree['SubhaloID']), dtype=np.int64)
+    ends = rows + (np.asarray(tree['MainLeafProgenitorID'], dtype=np.int64) - tree['SubhaloID'])
+
+    return np.clip(ends, rows, _treeLastRows(tree))
+
+
+def maxPastMasses(tree, partType='stars'):
+    """ Get maximum past mass (of the given partType) along the main branch of every subhalo in this
+        tree, or in many concatenated trees (loadTrees), at once. Same as maxPastMass() for each
+        index, using range maxima over the depth-first main branches instead of one slice per index. """
+    ptNum = partTypeNum(partType)
+
+    masses = np.asarray(tree['SubhaloMassType'][:, ptNum])
+    rows = np.arange(masses.size, dtype=np.int64)
+    ends = _mainBranchEnds(tree)
+
+    # split each range [i, ends[i]] into two overlapping ranges of power of two length 2^level, and
+    # take the maximum of both from a table of the maxima of all ranges of that length (built in turn)
+    lengths = ends - rows + 1
+    levels = np.floor(np.log2(np.maximum(lengths, 1))).astype(np.int64)
+
+    result = np.zeros_like(masses)
+    table = masses.copy()
+
+    for level in range(levels.max() + 1 if masses.size else 0):
+        size = 1 << level
+        w = np.where(levels == level)[0]
+        result[w] = np.maximum(table[w], table[ends[w] - size + 1])
+
+        table[:masses.size - size] = np.maximum(table[:masses.size - size], table[size:])
+
+    return result
+
+
+def mergerPairs(tree, massPartType='stars'):
+    """ Find every progenitor pair of this tree, or of many concatenated trees (loadTrees), at once:
+        each first progenitor ('first', row) and one of its next progenitors ('next', row), together
+        with the ratio of their maximum past masses ('ratio', next over first, nan if either is zero). """
+    reqFields = ['SubhaloID', 'NextProgenitorID', 'MainLeafProgenitorID', 'SubhaloMassType']
+
+    if not set(reqFields).issubset(tree.keys()):
+        raise Exception('Error: Input tree needs to have loaded fields: '+', '.join(reqFields))
+
+    rows = np.arange(len(tree['SubhaloID']), dtype=np.int64)
+
+    # row of the next progenitor of each row, if it is in the same tree
+    subhaloID = np.asarray(tree['SubhaloID'], dtype=np.int64)
+    npID = np.asarray(tree['NextProgenitorID'], dtype=np.int64)
+    npRows = rows + (npID - subhaloID)
+
+    w = np.where((npID != -1) & (npRows > rows) & (npRows <= _treeLastRows(tree)))[0]
+    w = w[subhaloID[npRows[w]] == npID[w]]
+
+    # follow the chains of next progenitors back to their first progenitor, by pointer jumping
+    first = rows.copy()
+    first[npRows[w]] = w
+
+    while True:
+        firstNext = first[first]
+        if np.array_equal(firstNext, first):
+            break
+        first = firstNext
+
+    nextRows = npRows[w]
+    firstRows = first[nextRows]
+
+    masses = maxPastMasses(tree, massPartType)
+    fpMass = masses[firstRows]
+    npMass = masses[nextRows]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = np.where((fpMass > 0.0) & (npMass > 0.0), npMass / fpMass, np.nan)
+
+    return {'count': nextRows.size, 'first': firstRows, 'next': nextRows, 'ratio': ratio}
+
+
+def mergerCounts(tree, minMassRatio=1e-10, massPartType='stars', alongFullTree=False):
+    """ Calculate the number of mergers, along the main progenitor branch (optionally above some
+        mass ratio threshold), of the sub-tree of every subhalo in this tree, or in many concatenated
+        trees (loadTrees), at once. Same as numMergers() for each index, e.g. the counts of the trees
+        of loadTrees() are at their 'offsets'. If alongFullTree, also count the mergers along the main
+        progenitor branch of each merging (next) progenitor. """
     reqFields = ['SubhaloID', 'NextProgenitorID', 'MainLeafProgenitorID',
                  'FirstProgenitorID', 'SubhaloMassType']
 
     if not set(reqFields).issubset(tree.keys()):
         raise Exception('Error: Input tree needs to have loaded fields: '+', '.join(reqFields))
 
-    num = 0
+    numRows = len(tree['SubhaloID'])
     invMassRatio = 1.0 / minMassRatio
 
-    # walk back main progenitor branch
+    pairs = mergerPairs(tree, massPartType)
+    counted = (pairs['ratio'] >= minMassRatio) & (pairs['ratio'] <= invMassRatio)
+
+    # mergers onto each first progenitor, summed over the main progenitor branch (below each row)
+    ends = _mainBranchEnds(tree)
+
+    def alongBranch(perRow):
+        cumulative = np.concatenate(([0], np.cumsum(perRow)))
+        return cumulative[ends + 1] - cumulative[np.arange(numRows) + 1]
+
+    num = alongBranch(np.bincount(pairs['first'][counted], minlength=numRows))
+
+    if alongFullTree:
+        perRow = np.bincount(pairs['first'][counted], minlength=numRows) + \
+                 np.bincount(pairs['first'], weights=num[pairs['next']], minlength=numRows).astype(np.int64)
+        num = alongBranch(perRow)
+
+    return num
+
+
+def _subtreeEnd(tree, index):
+    """ Return the last row of the sub-tree of row index (which, depth-first, holds its consecutive rows
+        up to there): that of its last progenitor, recursively. Stops at the end of the loaded rows. """
     rootID = tree['SubhaloID'][index]
-    fpID   = tree['FirstProgenitorID'][index]
+    numRows = len(tree['SubhaloID'])
 
-    while fpID != -1:
-        fpIndex = index + (fpID - rootID)
-        fpMass  = maxPastMass(tree, fpIndex, massPartType)
+    end = index
+    progID = tree['FirstProgenitorID'][index]
 
-        # explore breadth
-        npID = tree['NextProgenitorID'][fpIndex]
+    while progID != -1:
+        # last progenitor of row end, at the end of the chain of next progenitors
+        while progID != -1:
+            row = index + (progID - rootID)
+            if row >= numRows or tree['SubhaloID'][row] != progID:
+                return end
+            end = row
+            progID = tree['NextProgenitorID'][row]
 
-        while npID != -1:
-            npIndex = index + (npID - rootID)
-            npMass  = maxPastMass(tree, npIndex, massPartType)
+        progID = tree['FirstProgenitorID'][end]
 
-            # count if both masses are non-zero, and ratio exceeds threshold
-            if fpMass > 0.0 and npMass > 0.0:
-                ratio = npMass / fpMass
+    return end
 
-                if ratio >= minMassRatio and ratio <= invMassRatio:
-                    num += 1
 
-            npID = tree['NextProgenitorID'][npIndex]
+def numMergers(tree, minMassRatio=1e-10, massPartType='stars', index=0, alongFullTree=False):
+    """ Calculate the number of mergers, along the main progenitor branch, in this sub-tree 
+    (optionally above some mass ratio threshold). If alongFullTree, count across the full 
+    sub-tree and not only along the MPB. Only the rows of the sub-tree of index are used, but to
+    count for many subhalos, mergerCounts() does all at once. """
+    # verify the input sub-tree has the required fields
+    reqFields = ['SubhaloID', 'NextProgenitorID', 'MainLeafProgenitorID',
+                 'FirstProgenitorID', 'SubhaloMassType']
 
-            # count along full tree instead of just along the MPB? (non-standard)
-            if alongFullTree:
-                if tree['FirstProgenitorID'][npIndex] != -1:
-                    numSubtree = numMergers(tree, minMassRatio=minMassRatio, massPartType=massPartType, index=npIndex)
-                    num += numSubtree
+    if not set(reqFields).issubset(tree.keys()):
+        raise Exception('Error: Input tree needs to have loaded fields: '+', '.join(reqFields))
 
-        fpID = tree['FirstProgenitorID'][fpIndex]
+    end = _subtreeEnd(tree, index)
+    subtree = {field: tree[field][index:end+1] for field in reqFields}
 
-    return num
+    return int(mergerCounts(subtree, minMassRatio, massPartType, alongFullTree)[0])
@@ -132,3 +132,104 @@ def test_groupcat_loadSubhalos():
         np.allclose(subhalos['SubhaloMass'][:3], [2.21748203e+04, 2.21866333e+03, 5.73408325e+02]))
 
     return
+
+
+def test_groupcat_filePool():
+    # a tiny handle pool forces eviction between chunks but must not change results
+    fields = ['SubhaloMass', 'SubhaloSFRinRad']
+    snap = 135
+    ref = ill.groupcat.loadSubhalos(BASE_PATH_ILLUSTRIS_1, snap, fields=fields)
+
+    ill.util.setFilePool(maxOpen=2)
+    try:
+        subhalos = ill.groupcat.loadSubhalos(BASE_PATH_ILLUSTRIS_1, snap, fields=fields)
+        assert_true(len(ill.util.filePool) <= 2)
+    finally:
+        ill.util.setFilePool(maxOpen=64)
+
+    for field in fields:
+        assert_true(np.array_equal(subhalos[field], ref[field]))
+
+    return
+
+
+def test_groupcat_loadSubhalos_nThreads():
+    fields = ['SubhaloMass', 'SubhaloPos']
+    snap = 135
+    serial = ill.groupcat.loadSubhalos(BASE_PATH_ILLUSTRIS_1, snap, fields=fields, nThreads=1)
+    parallel = ill.groupcat.loadSubhalos(BASE_PATH_ILLUSTRIS_1, snap, fields=fields, nThreads=4)
+
+    for field in fields:
+        assert_true(np.array_equal(parallel[field], serial[field]))
+
+    return
+
+
+def test_groupcat_loadSingles():
+    snap = 135
+    ids = [4, 0, 3, 4]
+    singles = ill.groupcat.loadSingles(BASE_PATH_ILLUSTRIS_1, snap, subhaloIDs=ids)
+
+    # columns are aligned with the requested IDs, repeats included
+    assert_equal(singles['count'], len(ids))
+    for i, subhaloID in enumerate(ids):
+        single = ill.groupcat.loadSingle(BASE_PATH_ILLUSTRIS_1, snap, subhaloID=subhaloID)
+        for field in single:
+            assert_true(np.array_equal(singles[field][i], single[field]))
+
+    return
+
+
+def test_groupcat_query():
+    snap = 135
+    subhalos = ill.groupcat.loadSubhalos(BASE_PATH_ILLUSTRIS_1, snap, fields=['SubhaloMass', 'SubhaloPos'])
+    selected = ill.groupcat.query(BASE_PATH_ILLUSTRIS_1, snap, 'Subhalo', ('SubhaloMass', '>', 100.0),
+                                  fields=['SubhaloPos'])
+
+    w = np.where(subhalos['SubhaloMass'] > 100.0)[0]
+    assert_equal(selected['count'], w.size)
+    assert_true(np.array_equal(selected['index'], w))
+    assert_true(np.array_equal(selected['SubhaloPos'], subhalos['SubhaloPos'][w]))
+
+    return
+
+
+def test_groupcat_offsets():
+    snap = 135
+    offsets = ill.groupcat.loadOffsets(BASE_PATH_ILLUSTRIS_1, snap)
+    assert_true(offsets is ill.groupcat.loadOffsets(BASE_PATH_ILLUSTRIS_1, snap))
+
+    # vectorized lookups agree with the single-object ones
+    ids = np.array([5, 0, 100])
+    lenType = offsets.lenType('Subhalo', ids)
+    offsetType = offsets.table('Subhalo', 'SnapByType')[ids]
+
+    for i, subhaloID in enumerate(ids):
+        r = ill.snapshot.getSnapOffsets(BASE_PATH_ILLUSTRIS_1, snap, subhaloID, 'Subhalo')
+        assert_true(np.array_equal(lenType[i], r['lenType']))
+        assert_true(np.array_equal(offsetType[i], r['offsetType']))
+
+    return
+
+
+def test_groupcat_hierarchy():
+    snap = 135
+    hierarchy = ill.groupcat.loadHierarchy(BASE_PATH_ILLUSTRIS_1, snap)
+    halos = ill.groupcat.loadHalos(BASE_PATH_ILLUSTRIS_1, snap, fields=['GroupFirstSub', 'GroupNsubs'])
+    subhaloGrNr = ill.groupcat.loadSubhalos(BASE_PATH_ILLUSTRIS_1, snap, fields=['SubhaloGrNr'])
+
+    groupIDs = np.array([10, 0, 3])
+    r = hierarchy.subhalosOf(groupIDs)
+    assert_true(np.array_equal(r['lengths'], halos['GroupNsubs'][groupIDs]))
+
+    for i, groupID in enumerate(groupIDs):
+        subhalos = r['subhalos'][r['offsets'][i]:r['offsets'][i] + r['lengths'][i]]
+        assert_true(np.array_equal(hierarchy.parentOf(subhalos), np.full(subhalos.size, groupID)))
+        assert_equal(subhalos[0], halos['GroupFirstSub'][groupID])
+
+    subhaloIDs = np.arange(100)
+    assert_true(np.array_equal(hierarchy.parentOf(subhaloIDs), subhaloGrNr[subhaloIDs]))
+    assert_true(np.array_equal(hierarchy.isCentral(subhaloIDs),
+                               halos['GroupFirstSub'][subhaloGrNr[subhaloIDs]] == subhaloIDs))
+
+    return
@@ -66,13 +66,14 @@ def test_loadHalo():
     snap = 135
     halo_num = 100
 
-    # Values for Illustris-1, snap=135, halo 100
+    # Values for Illustris-1, snap=135, halo 100 (all of type 4)
     coords = [[19484.6576131, 20662.6423522],
               [54581.7254122, 55598.2078751],
               [60272.0348192, 61453.9991835]]
     stars_count = 981545
 
-    stars = ill.snapshot.loadHalo(BASE_PATH_ILLUSTRIS_1, snap, halo_num, 'stars')
+    # all type 4 particles, i.e. stars and wind together
+    stars = ill.snapshot.loadHalo(BASE_PATH_ILLUSTRIS_1, snap, halo_num, 4)
     assert_equal(stars["count"], stars_count)
     for i in range(3):
         _min = np.min(stars['Coordinates'][:, i])
@@ -83,3 +84,259 @@ def test_loadHalo():
         assert_true(np.isclose(_max, coords[i][1]))
 
     return
+
+
+def test_loadIndex():
+    snap = 135
+
+    # per-chunk counts of the index must add up to the header totals, for every type
+    index = ill.snapshot.loadIndex(BASE_PATH_ILLUSTRIS_1, snap)
+    numPart = ill.snapshot.getNumPart(index['header'])
+    assert_true(np.all(index['lenType'].sum(axis=0) == numPart))
+    assert_true(np.all(index['offsetType'][-1, :] == numPart))
+    assert_true('Coordinates' in index['fields'][4])
+
+    # a rebuilt index is identical to the cached one
+    index2 = ill.snapshot.loadIndex(BASE_PATH_ILLUSTRIS_1, snap, cache=False)
+    assert_true(np.all(index['lenType'] == index2['lenType']))
+    return
+
+
+def test_loadSubset_nThreads():
+    snap = 135
+    fields = ['Coordinates', 'Masses']
+
+    # a parallel read must be byte-identical to the serial one
+    subset = ill.snapshot.getSnapOffsets(BASE_PATH_ILLUSTRIS_1, snap, 100, 'Group')
+    serial = ill.snapshot.loadSubset(BASE_PATH_ILLUSTRIS_1, snap, 'stars', fields, subset=subset)
+    parallel = ill.snapshot.loadSubset(BASE_PATH_ILLUSTRIS_1, snap, 'stars', fields, subset=subset, nThreads=4)
+    assert_equal(serial['count'], parallel['count'])
+    for field in fields:
+        assert_true(np.array_equal(serial[field], parallel[field]))
+    return
+
+
+def test_loadSubhalos():
+    snap = 135
+    ids = [1032, 5, 17, 16, 17]
+    fields = ['Masses', 'ParticleIDs']
+
+    # batched load must agree with one loadSubhalo() call per subhalo, in the order of the input ids
+    subs = ill.snapshot.loadSubhalos(BASE_PATH_ILLUSTRIS_1, snap, ids, 'gas', fields=fields)
+    for i, id in enumerate(ids):
+        sub = ill.snapshot.loadSubhalo(BASE_PATH_ILLUSTRIS_1, snap, id, 'gas', fields=fields)
+        assert_equal(sub['count'], subs['lengths'][i])
+        sl = slice(subs['offsets'][i], subs['offsets'][i] + subs['lengths'][i])
+        for field in fields:
+            assert_true(np.array_equal(sub[field], subs[field][sl]))
+    return
+
+
+def test_iterSubset():
+    snap = 135
+    halo_num = 100
+    blockSize = 100000
+
+    # the concatenated blocks must reproduce the full load
+    subset = ill.snapshot.getSnapOffsets(BASE_PATH_ILLUSTRIS_1, snap, halo_num, 'Group')
+    masses = ill.snapshot.loadSubset(BASE_PATH_ILLUSTRIS_1, snap, 4, 'Masses', subset=subset)
+
+    offset = subset['offsetType'][4]
+    blocks = []
+    for block in ill.snapshot.iterSubset(BASE_PATH_ILLUSTRIS_1, snap, 4, 'Masses', subset=subset,
+                                         blockSize=blockSize):
+        assert_true(block['count'] <= blockSize)
+        assert_equal(block['offset'], offset)
+        offset += block['count']
+        blocks.append(block['Masses'])
+
+    assert_true(np.array_equal(np.concatenate(blocks), masses))
+    return
+
+
+def test_loadRegion():
+    snap = 135
+    halo_num = 100
+    radius = 50.0
+    fields = ['Coordinates', 'ParticleIDs']
+
+    header = ill.groupcat.loadHeader(BASE_PATH_ILLUSTRIS_1, snap)
+    boxSize = header['BoxSize']
+    center = ill.groupcat.loadSingle(BASE_PATH_ILLUSTRIS_1, snap, haloID=halo_num)['GroupPos']
+
+    region = ill.snapshot.loadRegion(BASE_PATH_ILLUSTRIS_1, snap, center, 'stars', fields, radius=radius)
+    dx = np.abs(region['Coordinates'] - center)
+    dx = np.minimum(dx, boxSize - dx)
+    assert_true(np.all(np.sum(dx**2, axis=1) <= radius**2))
+
+    # every star of the halo within the radius must have been found
+    stars = ill.snapshot.loadHalo(BASE_PATH_ILLUSTRIS_1, snap, halo_num, 'stars', fields)
+    dx = np.abs(stars['Coordinates'] - center)
+    dx = np.minimum(dx, boxSize - dx)
+    inside = stars['ParticleIDs'][np.sum(dx**2, axis=1) <= radius**2]
+    assert_true(np.all(np.isin(inside, region['ParticleIDs'])))
+    return
+
+
+def test_loadHalo_where():
+    snap = 135
+    halo_num = 100
+    fields = ['Masses', 'StarFormationRate']
+
+    # the filtered load must equal masking the full load
+    gas = ill.snapshot.loadHalo(BASE_PATH_ILLUSTRIS_1, snap, halo_num, 'gas', fields)
+    sfr = ill.snapshot.loadHalo(BASE_PATH_ILLUSTRIS_1, snap, halo_num, 'gas', fields,
+                                where=('StarFormationRate', '>', 0))
+    w = gas['StarFormationRate'] > 0
+    assert_equal(sfr['count'], np.count_nonzero(w))
+    assert_true(np.array_equal(sfr['Masses'], gas['Masses'][w]))
+    return
+
+
+def test_loadHalo_stars_wind():
+    snap = 135
+    halo_num = 100
+    fields = ['GFM_StellarFormationTime']
+
+    # stars and wind partition type 4
+    all4 = ill.snapshot.loadHalo(BASE_PATH_ILLUSTRIS_1, snap, halo_num, 4, fields)
+    stars = ill.snapshot.loadHalo(BASE_PATH_ILLUSTRIS_1, snap, halo_num, 'stars', fields)
+    wind = ill.snapshot.loadHalo(BASE_PATH_ILLUSTRIS_1, snap, halo_num, 'wind', fields)
+
+    assert_true(np.all(stars > 0))
+    assert_true(np.all(wind <= 0))
+    assert_equal(stars.size + wind.size, all4.size)
+    assert_true(np.array_equal(stars, all4[all4 > 0]))
+    return
+
+
+def test_simulation_layout():
+    snap = 135
+    sim = ill.util.simulation(BASE_PATH_ILLUSTRIS_1)
+    assert_true(sim is ill.util.simulation(BASE_PATH_ILLUSTRIS_1))
+
+    # the naming scheme resolved for chunk 0 is reused for the other chunks
+    path0 = ill.snapshot.snapPath(BASE_PATH_ILLUSTRIS_1, snap, 0)
+    assert_true(('snap', snap) in sim.schemes)
+    path1 = ill.snapshot.snapPath(BASE_PATH_ILLUSTRIS_1, snap, 1)
+    assert_equal(path1, path0.replace('.0.hdf5', '.1.hdf5'))
+
+    # forgetting the layout resolves to the same paths again
+    sim.forget()
+    assert_equal(ill.snapshot.snapPath(BASE_PATH_ILLUSTRIS_1, snap, 1), path1)
+    return
+
+
+def test_loadSample():
+    snap = 135
+    fields = ['Masses']
+
+    sample = ill.snapshot.loadSample(BASE_PATH_ILLUSTRIS_1, snap, 'gas', fields, fraction=0.001, seed=42,
+                                     sq=False)
+    numGas = ill.snapshot.loadIndex(BASE_PATH_ILLUSTRIS_1, snap)['numPart'][0]
+    assert_true(abs(sample['count'] - 0.001 * numGas) <= 1024)
+
+    # reproducible, and equal to the same particles of a full read
+    again = ill.snapshot.loadSample(BASE_PATH_ILLUSTRIS_1, snap, 'gas', fields, fraction=0.001, seed=42)
+    assert_true(np.array_equal(again, sample['Masses']))
+
+    i = sample['index'][-1]
+    subset = {'offsetType': [i, 0, 0, 0, 0, 0], 'lenType': [1, 0, 0, 0, 0, 0]}
+    last = ill.snapshot.loadSubset(BASE_PATH_ILLUSTRIS_1, snap, 'gas', fields, subset=subset)
+    assert_equal(last[0], sample['Masses'][-1])
+
+    # nothing sampled for fraction zero
+    empty = ill.snapshot.loadSample(BASE_PATH_ILLUSTRIS_1, snap, 'gas', fields, fraction=0)
+    assert_equal(empty['count'], 0)
+    assert_equal(empty['index'].size, 0)
+    return
+
+
+def test_loadByIDs():
+    snap = 135
+    halo_num = 100
+    fields = ['ParticleIDs', 'Masses']
+    gas = ill.snapshot.loadHalo(BASE_PATH_ILLUSTRIS_1, snap, halo_num, 'gas', fields)
+
+    # look up in reverse order, together with an ID which does not exist
+    ids = np.append(gas['ParticleIDs'][::-1], 0)
+    byID = ill.snapshot.loadByIDs(BASE_PATH_ILLUSTRIS_1, snap, 'gas', ids, fields)
+
+    assert_equal(byID['count'], gas['count'])
+    assert_equal(byID['index'][-1], -1)
+    assert_true(np.array_equal(byID['ParticleIDs'][:-1], gas['ParticleIDs'][::-1]))
+    assert_true(np.array_equal(byID['Masses'][:-1], gas['Masses'][::-1]))
+
+    track = ill.snapshot.trackIDs(BASE_PATH_ILLUSTRIS_1, [snap, snap], 'gas', ids, ['Masses'])
+    assert_equal(track['Masses'].shape, (2, ids.size))
+    assert_true(np.array_equal(track['index'][1], byID['index']))
+    return
+
+
+def test_loadTracerParents():
+    snap = 135
+    halo_num = 100
+    subset = ill.snapshot.getSnapOffsets(BASE_PATH_ILLUSTRIS_1, snap, halo_num, 'Group')
+
+    parents = ill.snapshot.loadTracerParents(BASE_PATH_ILLUSTRIS_1, snap, subset=subset,
+                                             parentFields=['ParticleIDs'])
+    tracers = ill.snapshot.loadHalo(BASE_PATH_ILLUSTRIS_1, snap, halo_num, 'tracers', ['ParentID'])
+    assert_equal(parents['count'], tracers.size)
+
+    # every resolved parent carries the ID the tracer points to, and lies within the halo
+    w = parents['ParentType'] >= 0
+    assert_true(np.count_nonzero(w) > 0)
+    assert_true(np.array_equal(parents['ParticleIDs'][w], tracers[w]))
+    for ptNum in [0, 4, 5]:
+        rows = parents['ParentIndex'][parents['ParentType'] == ptNum]
+        assert_true(np.all(rows >= subset['offsetType'][ptNum]))
+        assert_true(np.all(rows < subset['offsetType'][ptNum] + subset['lenType'][ptNum]))
+    return
+
+
+def test_loadHalo_derived():
+    snap = 135
+    halo_num = 100
+    gas = ill.snapshot.loadHalo(BASE_PATH_ILLUSTRIS_1, snap, halo_num, 'gas',
+                                ['InternalEnergy', 'ElectronAbundance', 'Coordinates'])
+    center = ill.groupcat.loadSingle(BASE_PATH_ILLUSTRIS_1, snap, haloID=halo_num)['GroupPos']
+
+    derived = ill.snapshot.loadHalo(BASE_PATH_ILLUSTRIS_1, snap, halo_num, 'gas', ['Temperature', 'Radius'],
+                                    params={'center': center})
+    assert_true(np.all(derived['Temperature'] > 0))
+    assert_true(np.allclose(derived['Temperature'],
+                            ill.snapshot._temperature(gas, {}).astype(np.float32), rtol=1e-5))
+    assert_true(np.allclose(derived['Radius'], np.linalg.norm(gas['Coordinates'] - center, axis=1), rtol=1e-4))
+    return
+
+
+def test_reduceByGroup():
+    snap = 135
+    masses = ill.snapshot.reduceByGroup(BASE_PATH_ILLUSTRIS_1, snap, 'gas', 'Masses', 'sum', 'Group')
+    counts = ill.snapshot.reduceByGroup(BASE_PATH_ILLUSTRIS_1, snap, 'gas', 'Masses', 'count', 'Group')
+    lenType = ill.groupcat.loadHalos(BASE_PATH_ILLUSTRIS_1, snap, fields=['GroupLenType'])
+
+    # every gas cell of every halo is counted once
+    assert_true(np.array_equal(counts, lenType[:, 0]))
+
+    for halo_num in [0, 100]:
+        gas = ill.snapshot.loadHalo(BASE_PATH_ILLUSTRIS_1, snap, halo_num, 'gas', ['Masses'])
+        assert_true(np.isclose(masses[halo_num], gas.sum(dtype=np.float64)))
+    return
+
+
+def test_loadMembership():
+    snap = 135
+    halo_num = 100
+    subset = ill.snapshot.getSnapOffsets(BASE_PATH_ILLUSTRIS_1, snap, halo_num, 'Group')
+    membership = ill.snapshot.loadMembership(BASE_PATH_ILLUSTRIS_1, snap, 'dm')
+
+    # all particles of the halo, and only those, point back to it
+    start, length = subset['offsetType'][1], subset['lenType'][1]
+    assert_true(np.all(membership['GroupIndex'][start:start+length] == halo_num))
+    assert_equal(np.count_nonzero(membership['GroupIndex'] == halo_num), length)
+
+    # also available as a pseudo-field
+    groupIndex = ill.snapshot.loadHalo(BASE_PATH_ILLUSTRIS_1, snap, halo_num, 'dm', ['GroupIndex'])
+    assert_true(np.all(groupIndex == halo_num))
+    return
@@ -82,3 +82,106 @@ def test_numMergers():
         assert_equal(_num_merg, nm)
 
     return
+
+
+def test_loadTrees():
+    fields = ['SubhaloMass', 'SubfindID', 'SnapNum']
+    snap = 135
+    start = 100
+
+    group_first_sub = ill.groupcat.loadHalos(BASE_PATH_ILLUSTRIS_1, snap, fields=['GroupFirstSub'])
+    ids = group_first_sub[start:start+5]
+
+    for onlyMPB in [False, True]:
+        trees = ill.sublink.loadTrees(BASE_PATH_ILLUSTRIS_1, snap, ids, fields=fields, onlyMPB=onlyMPB)
+        assert_equal(trees['count'], trees['lengths'].sum())
+
+        for i, id in enumerate(ids):
+            tree = ill.sublink.loadTree(BASE_PATH_ILLUSTRIS_1, snap, id, fields=fields, onlyMPB=onlyMPB)
+            offset, length = trees['offsets'][i], trees['lengths'][i]
+            assert_equal(tree['count'], length)
+            for field in fields:
+                assert_true(np.array_equal(tree[field], trees[field][offset:offset+length]))
+
+    return
+
+
+def test_mergerCounts():
+    snap = 135
+    ratio = 1.0/5.0
+    start = 100
+
+    # Values for Illustris-1, snap=135, start=100 (as in test_numMergers)
+    num_mergers = [2, 2, 3, 4, 3]
+
+    group_first_sub = ill.groupcat.loadHalos(BASE_PATH_ILLUSTRIS_1, snap, fields=['GroupFirstSub'])
+
+    fields = ['SubhaloID', 'NextProgenitorID', 'MainLeafProgenitorID',
+              'FirstProgenitorID', 'SubhaloMassType']
+    trees = ill.sublink.loadTrees(BASE_PATH_ILLUSTRIS_1, snap, group_first_sub[start:start+5], fields=fields)
+
+    # all trees at once, read off at the root of each
+    counts = ill.sublink.mergerCounts(trees, minMassRatio=ratio)
+    assert_true(np.array_equal(counts[trees['offsets']], num_mergers))
+
+    masses = ill.sublink.maxPastMasses(trees)
+    for index in trees['offsets']:
+        assert_equal(masses[index], ill.sublink.maxPastMass(trees, index))
+
+    return
+
+
+def test_loadBranches():
+    fields = ['SubhaloMass', 'SnapNum']
+    snap = 135
+    start = 100
+
+    group_first_sub = ill.groupcat.loadHalos(BASE_PATH_ILLUSTRIS_1, snap, fields=['GroupFirstSub'])
+    ids = group_first_sub[start:start+5]
+
+    branches = ill.sublink.loadBranches(BASE_PATH_ILLUSTRIS_1, snap, ids, fields=fields)
+    assert_equal(branches['rows'].shape, (ids.size, 136))
+
+    for i, id in enumerate(ids):
+        tree = ill.sublink.loadTree(BASE_PATH_ILLUSTRIS_1, snap, id, fields=fields, onlyMPB=True)
+
+        # padded by snapshot, from the first snapshot up to snap
+        w = branches['rows'][i] >= 0
+        assert_true(np.array_equal(np.where(w)[0], tree['SnapNum'][::-1]))
+        assert_true(np.array_equal(branches['SubhaloMass'][i][w], tree['SubhaloMass'][::-1]))
+
+    return
+
+
+def test_crossMatch():
+    snap = 135
+    start = 100
+
+    group_first_sub = ill.groupcat.loadHalos(BASE_PATH_ILLUSTRIS_1, snap, fields=['GroupFirstSub'])
+    progenitors = ill.sublink.crossMatch(BASE_PATH_ILLUSTRIS_1, snap, 100)
+
+    for id in group_first_sub[start:start+5]:
+        tree = ill.sublink.loadTree(BASE_PATH_ILLUSTRIS_1, snap, id, fields=['SubfindID', 'SnapNum'],
+                                    onlyMPB=True)
+        w = np.where(tree['SnapNum'] == 100)[0]
+        assert_equal(progenitors[id], tree['SubfindID'][w[0]] if w.size else -1)
+
+        # and back again
+        if w.size:
+            descendants = ill.sublink.crossMatch(BASE_PATH_ILLUSTRIS_1, 100, snap)
+            assert_equal(descendants[progenitors[id]], id)
+
+    return
+
+
+def test_subLinkOffsets():
+    tree_name = 'SubLink'
+    offsets = ill.sublink.subLinkOffsets(BASE_PATH_ILLUSTRIS_1, tree_name)
+
+    # same as a full (serial) scan of the tree files
+    scanned = ill.sublink.subLinkOffsets(BASE_PATH_ILLUSTRIS_1, tree_name, cache=False, nThreads=1)
+    assert_true(np.array_equal(offsets, scanned))
+    assert_equal(offsets[0], 0)
+    assert_true(np.all(np.diff(offsets) > 0))
+
+    return
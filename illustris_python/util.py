@@ -1,24 +1,447 @@
-""" Illustris Simulation: Public Data Release.
-util.py: Various helper functions. """
-
-def partTypeNum(partType):
-    """ Mapping between common names and numeric particle types. """
-    if str(partType).isdigit():
-        return int(partType)
-        
-    if str(partType).lower() in ['gas','cells']:
-        return 0
-    if str(partType).lower() in ['dm','darkmatter']:
-        return 1
-    if str(partType).lower() in ['dmlowres']:
-        return 2 # only zoom simulations, not present in full periodic boxes
-    if str(partType).lower() in ['tracer','tracers','tracermc','trmc']:
-        return 3
-    if str(partType).lower() in ['star','stars','stellar']:
-        return 4 # only those with GFM_StellarFormationTime>0
-    if str(partType).lower() in ['wind']:
-        return 4 # only those with GFM_StellarFormationTime<0
-    if str(partType).lower() in ['bh','bhs','blackhole','blackholes']:
-        return 5
-    
-    raise Exception("Unknown particle type name.")
+""" Illustris Simulation: Public Data Release.
+util.py: Various helper functions. """
+
+import numpy as np
+import h5py
+import os
+import mmap
+import weakref
+from os import environ, getpid, makedirs, register_at_fork, remove, replace
+from os.path import abspath, expanduser, isfile, join
+from glob import glob, has_magic
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import current_process
+from contextlib import contextmanager
+from threading import RLock
+
+
+def partTypeNum(partType):
+    """ Mapping between common names and numeric particle types. """
+    if str(partType).isdigit():
+        return int(partType)
+        
+    if str(partType).lower() in ['gas','cells']:
+        return 0
+    if str(partType).lower() in ['dm','darkmatter']:
+        return 1
+    if str(partType).lower() in ['dmlowres']:
+        return 2 # only zoom simulations, not present in full periodic boxes
+    if str(partType).lower() in ['tracer','tracers','tracermc','trmc']:
+        return 3
+    if str(partType).lower() in ['star','stars','stellar']:
+        return 4 # only those with GFM_StellarFormationTime>0
+    if str(partType).lower() in ['wind']:
+        return 4 # only those with GFM_StellarFormationTime<0
+    if str(partType).lower() in ['bh','bhs','blackhole','blackholes']:
+        return 5
+    
+    raise Exception("Unknown particle type name.")
+
+
+def partTypeWhere(partType):
+    """ Condition (see whereMask) selecting a logical particle type among all particles of its numeric
+        type, or None if the name refers to the numeric type as a whole. Stars and wind phase cells
+        share type 4, and differ in the sign of GFM_StellarFormationTime. """
+    if str(partType).lower() in ['star','stars','stellar']:
+        return ('GFM_StellarFormationTime', '>', 0)
+    if str(partType).lower() in ['wind']:
+        return ('GFM_StellarFormationTime', '<=', 0)
+
+    return None
+
+
+def cachePath(basePath, name):
+    """ Return absolute path to a file in the local cache directory of one simulation (modify as needed).
+        Persistent indices derived from the data are stored here, since the data directories themselves
+        are usually read-only. The cache root can be set with the ILLUSTRIS_CACHE environment variable. """
+    cacheRoot = environ.get('ILLUSTRIS_CACHE', join(expanduser('~'), '.cache', 'illustris_python'))
+    simName = abspath(expanduser(basePath)).strip('/').replace('/', '_')
+
+    cacheDir = join(cacheRoot, simName)
+    makedirs(cacheDir, exist_ok=True)
+
+    return join(cacheDir, name)
+
+
+class Simulation(object):
+    """ Memoized on-disk layout of one simulation (see simulation() for the shared instance per basePath).
+        The path functions of each submodule (snapPath, gcPath, treePath, ...) list the candidate naming
+        schemes, and resolve() remembers which of them exists, so that the filesystem is only probed the
+        first time. Values derived from the files, such as chunk counts, catalog headers and the indices
+        of the loaders (e.g. snapshot.loadIndex), are kept in values, mostly by memo(). Call forget() if
+        files are added or moved while the process is running. """
+
+    def __init__(self, basePath):
+        self.basePath = basePath
+        self.schemes = {}
+        self.values = {}
+
+    def resolve(self, key, candidates):
+        """ Return the first of the candidate paths which exists (glob patterns must match at least one
+            file), and remember its position under key so that later calls, e.g. for other chunks, pick
+            the same scheme without checking. Return None, remembering nothing, if none exists. """
+        if key in self.schemes:
+            return candidates[self.schemes[key]]
+
+        for i, path in enumerate(candidates):
+            path = expanduser(path)
+            if isfile(path) or (has_magic(path) and len(glob(path))):
+                self.schemes[key] = i
+                return candidates[i]
+
+        return None
+
+    def memo(self, key, func):
+        """ Return func(), evaluated only once for each key. """
+        if key not in self.values:
+            self.values[key] = func()
+        return self.values[key]
+
+    def count(self, key, pattern):
+        """ Number of files matching the glob pattern, counted only once for each key. """
+        return self.memo(key, lambda: len(glob(expanduser(pattern))))
+
+    def forget(self):
+        """ Drop everything resolved and derived so far, including the indices kept in memory by the
+            loaders (their sidecar files are checked against the files again when next needed). Files
+            held open by openFile() are not closed, see closeFiles(). """
+        self.schemes.clear()
+        self.values.clear()
+
+
+simulations = dict()
+
+def simulation(basePath):
+    """ Return the shared Simulation layout of basePath. """
+    if basePath not in simulations:
+        simulations[basePath] = Simulation(basePath)
+    return simulations[basePath]
+
+
+def mapDataset(path, name):
+    """ Memory-map a dataset of an HDF5 file (read-only), such that only the pages which are accessed
+        are read. Only possible for contiguous, uncompressed datasets: others are read into memory. """
+    with h5py.File(path, 'r') as f:
+        dset = f[name]
+        offset = dset.id.get_offset()
+        if offset is None or dset.chunks is not None: # chunked, or nothing stored yet (empty dataset)
+            return dset[()]
+        return np.memmap(path, dtype=dset.dtype, mode='r', offset=offset, shape=dset.shape)
+
+
+def _readArrays(f):
+    """ Return all datasets of an open HDF5 file by name, memory-mapped if it is on disk. """
+    names = []
+    f.visititems(lambda name, obj: names.append(name) if isinstance(obj, h5py.Dataset) else None)
+
+    if f.driver == 'core':
+        return {name: f[name][()] for name in names}
+    return {name: mapDataset(f.filename, name) for name in names}
+
+
+def _createUnlocked(path):
+    """ Create a new HDF5 file without locking it (where supported), such that worker processes forked
+        while it is open (see parallelMap), which inherit its handle, do not keep it locked. """
+    try:
+        return h5py.File(path, 'w', locking=False)
+    except (TypeError, ValueError):
+        return h5py.File(path, 'w') # h5py or HDF5 without file locking options
+
+
+def _buildInto(f, build):
+    """ Let build() fill the open HDF5 file f, storing the arrays it returns (if any). """
+    arrays = build(f)
+
+    # stored contiguous and uncompressed, such that it can be memory-mapped
+    for name, value in (arrays or {}).items():
+        f[name] = value
+
+
+def cachedArrays(basePath, name, stamp, build, cache=True, read=_readArrays):
+    """ Return arrays derived from the data of one simulation, kept in the sidecar file name (see
+        cachePath) such that they are only built once. build(f) either writes its datasets into the
+        (new, empty) HDF5 file f, or returns them as a dict. stamp() identifies the source files: the
+        sidecar is rebuilt whenever it changes. The sidecar is written atomically, so concurrent jobs
+        never see a partial file. Returns read(f) of the file, by default a dict of all its datasets,
+        memory-mapped. If cache is False, or the cache directory is not available (or not writable),
+        build in memory only, without touching the cache directory. Errors of stamp() and build() are
+        raised as they are. """
+    path = None
+    tmpFile = None
+
+    if cache:
+        try:
+            path = cachePath(basePath, name)
+        except OSError:
+            pass # cache directory not available, keep the arrays in memory only
+
+    if path is not None:
+        stampValue = stamp()
+
+        if isfile(path):
+            try:
+                with h5py.File(path, 'r') as f:
+                    if np.array_equal(f.attrs['SourceStamp'], stampValue):
+                        return read(f)
+            except OSError:
+                pass # unreadable sidecar, rebuild it
+
+        tmpPath = path + '.' + str(getpid()) + '.tmp'
+        try:
+            tmpFile = _createUnlocked(tmpPath)
+        except OSError:
+            pass # cache directory not writable, keep the arrays in memory only
+
+    if tmpFile is None:
+        with h5py.File(name, 'w', driver='core', backing_store=False) as f:
+            _buildInto(f, build)
+            return read(f)
+
+    try:
+        with tmpFile as f:
+            f.attrs['SourceStamp'] = stampValue
+            _buildInto(f, build)
+        replace(tmpPath, path)
+    except BaseException:
+        if isfile(tmpPath):
+            remove(tmpPath)
+        raise
+
+    with h5py.File(path, 'r') as f:
+        return read(f)
+
+
+processPools = dict()
+
+# worker processes belong to the process which started them, so a child process must start its own pools
+register_at_fork(after_in_child=processPools.clear)
+
+def processPool(nProcs):
+    """ Return a pool of nProcs worker processes, created on first use and then reused by all loaders. """
+    if nProcs not in processPools:
+        processPools[nProcs] = ProcessPoolExecutor(max_workers=nProcs)
+
+    return processPools[nProcs]
+
+
+def numProcs(nThreads):
+    """ Number of worker processes used by parallelMap() for nThreads: OMP_NUM_THREADS if None, and none
+        within a daemonic process (e.g. of multiprocessing.Pool), which cannot start any. """
+    if nThreads is None:
+        nThreads = int(environ.get('OMP_NUM_THREADS', 1))
+
+    return 1 if current_process().daemon else nThreads
+
+
+def parallelMap(func, nThreads, *iterables):
+    """ Return an iterator over func(*args), for the arguments taken from iterables, in order. If
+        nThreads > 1, evaluate in that many worker processes (see processPool), which read and decompress
+        concurrently. Threads would not: h5py serializes all its calls within one process. Hence func
+        and its arguments must be picklable, and func returns its (small) result, or writes large ones
+        into arrays from sharedZeros(). If nThreads is None (take it from OMP_NUM_THREADS, see
+        numProcs), the pool only serves this call, instead of being kept for later ones. """
+    nProcs = numProcs(nThreads)
+
+    if nProcs <= 1:
+        return map(func, *iterables)
+
+    if nThreads is None:
+        with ProcessPoolExecutor(max_workers=nProcs) as pool:
+            return list(pool.map(func, *iterables))
+
+    return processPool(nProcs).map(func, *iterables)
+
+
+sharedFds = dict()
+
+def _closeShared(key, fd):
+    """ Release the file of a shared array, once its memory is unmapped. """
+    sharedFds.pop(key, None)
+    os.close(fd)
+
+def sharedZeros(shape, dtype):
+    """ Return a new array of zeros, like np.zeros, whose memory worker processes can write into
+        (see sharedSpec and openShared), such that they read data directly into it. It is an anonymous
+        file in memory (os.memfd_create), freed with the array. Where this is not available (outside of
+        Linux), or for empty arrays, return a plain array, which has no sharedSpec. """
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+
+    if not nbytes or not hasattr(os, 'memfd_create'):
+        return np.zeros(shape, dtype=dtype)
+
+    fd = os.memfd_create('illustris_python')
+    try:
+        os.ftruncate(fd, nbytes)
+        buf = mmap.mmap(fd, nbytes)
+    except OSError:
+        os.close(fd)
+        return np.zeros(shape, dtype=dtype)
+
+    sharedFds[id(buf)] = (getpid(), fd)
+    weakref.finalize(buf, _closeShared, id(buf), fd)
+
+    return np.frombuffer(buf, dtype=dtype).reshape(shape)
+
+def sharedSpec(array):
+    """ Return a picklable (path, dtype, shape) by which worker processes can open an array from
+        sharedZeros() (see openShared), or None for any other array (or a view of part of one). """
+    base = array
+    while isinstance(base, np.ndarray):
+        base = base.base
+
+    buf = base.obj if isinstance(base, memoryview) else None
+    if id(buf) not in sharedFds or array.nbytes != len(buf) or not array.flags['C_CONTIGUOUS']:
+        return None
+
+    pid, fd = sharedFds[id(buf)]
+    return '/proc/%d/fd/%d' % (pid, fd), array.dtype.str, array.shape
+
+def openShared(spec):
+    """ Map an array from sharedZeros() (by its sharedSpec), e.g. within a worker process, for writing. """
+    path, dtype, shape = spec
+    return np.memmap(path, dtype=dtype, mode='r+', shape=shape)
+
+
+def readRows(dset, rows, maxGap=4096):
+    """ Read the given (sorted, unique) rows of an HDF5 dataset. Nearby rows, at most maxGap apart, are
+        coalesced into one contiguous read, such that many scattered rows need only a few large reads
+        instead of one small read (or one point selection) per row. """
+    rows = np.asarray(rows, dtype=np.int64)
+    result = np.zeros((rows.size,) + dset.shape[1:], dtype=dset.dtype)
+
+    if rows.size == 0:
+        return result
+
+    # split into runs wherever the gap between consecutive rows is large
+    breaks = np.where(np.diff(rows) > maxGap)[0] + 1
+    runStarts = np.concatenate(([0], breaks))
+    runEnds = np.concatenate((breaks, [rows.size]))
+
+    for i0, i1 in zip(runStarts, runEnds):
+        rowStart = rows[i0]
+        rowEnd = rows[i1 - 1] + 1
+        result[i0:i1] = dset[rowStart:rowEnd][rows[i0:i1] - rowStart]
+
+    return result
+
+
+whereOps = {'<' : np.less, '<=' : np.less_equal, '>' : np.greater, '>=' : np.greater_equal,
+            '==' : np.equal, '!=' : np.not_equal}
+
+def _whereConditions(where):
+    """ Normalize a where argument into a list of conditions. """
+    if isinstance(where, tuple):
+        return [where]
+    return list(where)
+
+
+def whereFields(where):
+    """ Return the list of fields needed to evaluate a where argument (see whereMask). """
+    fields = []
+    for condition in _whereConditions(where):
+        if condition[0] not in fields:
+            fields.append(condition[0])
+    return fields
+
+
+def whereMask(where, data):
+    """ Evaluate a where argument on a dict of field arrays, returning a boolean mask of matching rows.
+        A condition is either a (field, op, value) tuple, where op is one of '<', '<=', '>', '>=', '==',
+        '!=', or a (field, func) tuple, where func(array) returns a boolean mask. where is either a
+        single condition or a list of conditions, all of which must hold. """
+    mask = None
+
+    for condition in _whereConditions(where):
+        if len(condition) == 3:
+            field, op, value = condition
+            if op not in whereOps:
+                raise Exception("Unknown comparison ["+str(op)+"] in where condition.")
+            w = whereOps[op](data[field], value)
+        else:
+            field, func = condition
+            w = np.asarray(func(data[field]), dtype=bool)
+
+        if w.shape != data[field].shape[0:1]:
+            raise Exception("Where condition on field ["+field+"] does not give one value per row.")
+
+        mask = w if mask is None else (mask & w)
+
+    return mask
+
+
+# pool of open read-only HDF5 files shared by all loaders: path -> [h5py.File, number of current users]
+filePool = OrderedDict()
+filePoolConfig = {'maxOpen': 64, 'rdcc_nbytes': None, 'rdcc_nslots': None, 'rdcc_w0': None, 'pid': getpid()}
+filePoolLock = RLock()
+
+def _resetFilePool():
+    """ Forget all handles inherited from the parent process (used after fork, in the child). """
+    global filePoolLock
+    filePoolLock = RLock()
+    filePool.clear()
+    filePoolConfig['pid'] = getpid()
+
+register_at_fork(after_in_child=_resetFilePool)
+
+def _evictFiles(maxOpen):
+    """ Close least recently used handles, which are not currently in use, until at most maxOpen remain. """
+    for path in list(filePool.keys()):
+        if len(filePool) <= maxOpen:
+            break
+        if filePool[path][1] == 0:
+            filePool.pop(path)[0].close()
+
+
+def setFilePool(maxOpen=None, rdcc_nbytes=None, rdcc_nslots=None, rdcc_w0=None):
+    """ Configure the shared pool of open HDF5 files: the maximum number of files kept open, and the
+        HDF5 raw data chunk cache of each file (size in bytes, number of hash slots, and preemption
+        policy, see h5py.File). Changed cache settings apply to files opened afterwards, so all unused
+        handles are closed. """
+    with filePoolLock:
+        if maxOpen is not None:
+            filePoolConfig['maxOpen'] = int(maxOpen)
+
+        cache = {'rdcc_nbytes': rdcc_nbytes, 'rdcc_nslots': rdcc_nslots, 'rdcc_w0': rdcc_w0}
+        cache = {key: value for key, value in cache.items() if value is not None}
+
+        if cache:
+            filePoolConfig.update(cache)
+            _evictFiles(0)
+        else:
+            _evictFiles(filePoolConfig['maxOpen'])
+
+
+def closeFiles():
+    """ Close all open handles of the shared file pool which are not currently in use. """
+    with filePoolLock:
+        _evictFiles(0)
+
+
+@contextmanager
+def openFile(path):
+    """ Context manager giving a read-only h5py.File for path, taken from the shared pool of open files
+        (see setFilePool). The file stays open after the block, for reuse by later calls, until it is
+        evicted as the least recently used once more than maxOpen files are open. Safe to use from
+        several threads, and after fork (a child process opens its own handles). """
+    if filePoolConfig['pid'] != getpid():
+        _resetFilePool()
+
+    with filePoolLock:
+        if path in filePool:
+            filePool.move_to_end(path)
+            entry = filePool[path]
+            entry[1] += 1
+        else:
+            cache = {key: filePoolConfig[key] for key in ['rdcc_nbytes', 'rdcc_nslots', 'rdcc_w0']
+                     if filePoolConfig[key] is not None}
+            entry = [h5py.File(path, 'r', **cache), 1]
+            filePool[path] = entry
+            _evictFiles(filePoolConfig['maxOpen'])
+
+    try:
+        yield entry[0]
+    finally:
+        with filePoolLock:
+            entry[1] -= 1